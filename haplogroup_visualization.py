@@ -14,30 +14,105 @@ The program opens the map automatically in the browser.
 
 
 User-defined functions: create_Sunburst, creates interactive sunburst plot
-Non-standard modules: numpy, pandas, plotly, folium, branca, and sklearn
+                        sunburst_colors, sunburst_figure, build the sunburst chart (plotly graph_objects or express)
+                        sunburst_html, iframe_popup, render_popup, render_popups, render the popups (in parallel processes with --jobs)
+                        create_sunburst_div, sunburst_figure_spec, marker_record, lazy_cluster_record, lazy_layer_data, add_zoom_levels, add_client_markers, popup data and markers rendered in the map page (shared/lazy popup mode)
+                        sidecar_cluster_record, sidecar_dir, write_sidecar_files, per-cluster popup data files fetched by the map page (sidecar popup mode)
+                        script_json, page_element, add_plotly, add_page_popups, add plotly.js, the popup data and popup script to the map page
+                        haplogroup_count_matrix, counts individuals per cluster and haplogroup hierarchy node
+                        sunburst_arrays, slices the sunburst hierarchy of a cluster from the counts
+                        export_haplogroup_counts, writes the haplogroup counts per cluster to csv
+                        cluster_estimator, cluster_locations, cluster the sample locations with K-Means (or MiniBatchKMeans)
+                        cluster_cache_path, keys the cached clusterings (labels and centers) in the cache directory
+                        sphere_coordinates, lat_long_coordinates, convert locations to unit vectors and back (sphere geometry)
+                        bin_locations, assigns the sample locations to fixed hexagonal or equal-area grid cells (--binning)
+                        label_samples, joins the cluster labels onto the samples
+                        cluster_metadata, aggregates individuals, BP ranges and countries per cluster
+                        cluster_bp_range, popup_legend, formats the legend of a cluster's sunburst chart
+                        export_cluster_table, writes a cluster metadata table to csv
+                        cluster_layer, clusters a layer (Y or mt) and aggregates its clusters
+                        rollup_clusters, cluster_hierarchy, merge clusters into coarser levels for zoomed-out views (sums the counts)
+                        popup_tasks, layer_pipeline, logged_layer_pipeline, run_layer_pipelines, cluster and render the popups of Y and mt (concurrently)
+                        add_cluster_markers, adds a marker with sunburst popup per cluster to a map layer
+                        local_tiles_url, create_map, add_bp_range_filter, set up the map (satellite or local tiles), its layers and filter buttons
+                        network_files, missing_assets, localize_assets, report_bundle_size, use local library copies (required offline), print the map file size
+                        parse_k_values, sweep_fit, sweep_cluster_numbers, sweep_map, cluster number sweep (inertia, silhouette score and maps per k)
+                        coarse_to_fine, elbow_k, auto_cluster_number, choose a cluster number within a time budget (--cluster_Y/--cluster_mt auto)
+                        benchmark_engines, benchmark_renderers, compare the run time (and inertia) of the clustering engines and sunburst renderers
+                        server_page, filter_mean_bp, server_query, serve_map, serve the map and cluster data from a local web server
+                        timed_stage, report_timings, measure and print the run time of the program stages
+                        main, runs the program
+                        file_digest, hashes the input file for the cache
+                        match_annotation_column, select_annotation_columns, find the used columns by their headers
+                        missing_values_as_nan, detect_input_format, read_annotations_file, read the used columns of the input file (excel or text)
+                        load_annotations, reads the input file via a columnar (Feather) cache
+                        preprocess_annotations, cleans the input table and splits it into Y and mt tables
+                        cleaning_rules_digest, hashes the preprocessing code for the cache
+                        load_cleaned_tables, returns the preprocessed Y and mt tables via the cache
+                        report_cache, prints the cache hits and misses of a run
+                        terminate, writable_path, cluster_number, parse_arguments, check the command-line arguments
+Non-standard modules: numpy, pandas, plotly, folium, branca and jinja2 (installed with folium), sklearn, scipy and threadpoolctl (installed with sklearn) (optional: pyarrow, for the cache)
+                      (imported in the functions using them, e.g. sklearn only for the clustering)
 
 
 Procedure:
-    1. Define function for creating sunburst plots
-    2. Input validation
-        2.1 Check number of command-line arguments
-        2.2 Verify input file name
-    3. Data preprocessing
-        3.1 Filter and clean dataset (remove irrelevant columns, correct country names, handle missing values)
+    1. Define functions (sunburst plots, cached input loading, preprocessing, clustering, map) and run main
+    2. Input validation (parse_arguments, before the non-standard modules are imported)
+        2.1 Parse command-line arguments
+        2.2 Verify input file exists and its format (excel, or tab-separated .anno/.tsv or .csv)
+        2.3 Check cluster numbers and that the output file and cache directory are writable
+        2.4 Load the preprocessed tables from the cache, or load the used columns of the input file and run step 3
+    3. Data preprocessing (preprocess_annotations)
+        3.1 Clean dataset (correct country names, handle missing values)
         3.2 Add age coloumn for years in BC/AD
         3.3 Create separate tables for mt and Y data
         3.4 Group samples by chronological ranges
         3.5 Extract haplogroup subcategories
     4. Initialize map
-    5. Apply K-Means clustering to group geographic locations
+    5. Apply K-Means clustering to group geographic locations (weighted by their number of individuals, cached)
     6. Loop thorugh clusters to add markers and corresponding popup sunburst charts
-    7. Save and open the interactive map in the browser
+    7. Add BP range filter, save and open the interactive map in the browser
 
 
-Input: AADR Annotations 2025.xlsx
+Input: AADR Annotations 2025.xlsx (or an AADR .anno release file, or .tsv/.csv with the same column headers)
 
 Usage:
-python haplogroup_visualization.py --cluster_Y (optional flag followed by an int) --cluster_mt (optional flag followed by an int) "AADR Annotations 2025.xlsx"
+python haplogroup_visualization.py --cluster_Y (optional flag followed by an int or auto) --cluster_mt (optional flag followed by an int or auto) "AADR Annotations 2025.xlsx"
+Automatic cluster numbers: --auto_budget (optional flag followed by seconds per layer for choosing an auto cluster number, default: 10)
+Output options: --output (optional flag followed by the output html file, default: map.html)
+                --renderer (optional flag followed by go or px, sunburst renderer, default: go)
+                --jobs (optional flag followed by an int, processes rendering the popups, 0 for one per CPU, default: 1)
+                --popup_mode (optional flag followed by iframe, shared, lazy or sidecar, shared loads plotly.js once for all popups,
+                              lazy also builds the charts in the browser from the haplogroup counts,
+                              sidecar writes the markers and clusters to files in <output>_data fetched when shown, default: iframe)
+                --binning (optional flag followed by hex or grid, fixed grid cells instead of clusters)
+                --cell_size (optional flag followed by the cell size of the binning in degrees, default: 3)
+                --zoom_levels (optional flag, shows coarser merged clusters when zoomed out, lazy popup mode)
+                --offline (optional flag, inlines plotly.js once in the map file and requires --assets_dir with local copies of all map libraries,
+                           lazy popup mode by default, prints the file size)
+                --tiles_dir (optional flag followed by a directory of local {z}/{x}/{y}.png map tiles)
+                --assets_dir (optional flag followed by a directory of local copies of the map libraries, e.g. leaflet.js)
+                --cluster_table (optional flag followed by a file prefix, exports the cluster metadata tables and haplogroup counts as csv)
+Cache options: --cache_dir (optional flag followed by a directory) --refresh_cache (optional flag, re-parses the input file and re-clusters) --cache_report (optional flag, prints cache hits and misses)
+Timing option: --timings (optional flag, prints the run time of the program stages incl. startup)
+Clustering options: --cluster_engine (optional flag followed by kmeans, single_init or minibatch, default: kmeans)
+                    --unweighted (optional flag, every location counts once instead of by its number of individuals)
+                    --geometry (optional flag followed by planar or sphere, clusters on the unit sphere, default: planar)
+Concurrency option: --sequential_layers (optional flag, clusters Y and mt one after the other instead of in two processes)
+
+Clustering engine and renderer benchmark:
+python haplogroup_visualization.py benchmark (optional cluster and cache flags) "AADR Annotations 2025.xlsx"
+
+Cluster number sweep:
+python haplogroup_visualization.py sweep (optional cluster and cache flags) --k (optional, cluster numbers, e.g. 50,100,150 or 25-500:25, default 25-500:25)
+                                         --jobs (optional, processes fitting the clusterings, 0 for one per CPU, default 1) --maps (optional, file prefix of one map per k) "AADR Annotations 2025.xlsx"
+
+Map server:
+python haplogroup_visualization.py serve (optional cluster and cache flags) --host (optional, default 127.0.0.1) --port (optional, default 8000)
+                                         --tiles_dir (optional, local map tiles) --assets_dir (optional, local copies of the map libraries) "AADR Annotations 2025.xlsx"
+
+Exit codes: 0 success, 2 invalid arguments (or server port unavailable), 3 input file (or tiles/assets directory, or an offline map library) missing, 4 unsupported input format,
+            5 cluster number out of range, 6 output not writable, 7 used column missing in input file
 
 
 Version: 1.00
@@ -52,69 +127,180 @@ Git repository: https://github.com/RieskampLR/Population_Genetics_Project-2025.g
 # Library imports:
 
 import os
+import re
 import sys
-import numpy as np
-import pandas as pd
+import time
+import json
+import shutil
+import hashlib
+import inspect
+import string
 import argparse
-import plotly.io as pio
-import plotly.express as px
-import folium
-from folium.plugins import GroupedLayerControl, TagFilterButton
-import branca
-from sklearn.cluster import KMeans
+import contextlib
+
+# Start time of the program (for the stage timings)
+START_TIME = time.perf_counter()
+
+# The non-standard modules are imported in the functions that use them, so that e.g. --help
+# and invalid arguments need no import time and sklearn/plotly are only loaded when needed
 
 
 
 ###############################################################################
 
-# Function for sunburst charts:
-def create_Sunburst(subdataset):
+# Functions for sunburst charts:
+
+# Haplogroup subcategory columns forming the sunburst hierarchy (1, 2, 3 and 5 letters)
+HAPLOGROUP_PATH = ['first_letter', 'first_two_letters', 'first_three_letters', 'first_five_letters']
+
+# Defining custom colours to ensure Haplogroups maintain same colour across charts
+HAPLOGROUP_COLORS = {
+    'A': '#4863A0', 'B': 'orange', 'C': '#FBBBB9', 'D': '#CC7A8B', 'E': '#FBE7A1',
+    'G': '#BDF516', 'H': '#348781', 'I': '#654321', 'J': '#C83F49', 'K': '#9F000F',
+    'L': '#004225', 'M': '#FEF250', 'N': '#46C7C7', 'O': '#550A35', 'P': 'indigo',
+    'Q': '#C2E5D3', 'R': '#3B3131', 'T': '#667C26', 'U': '#9E7BFF', 'W': '#736F6E',
+    'X': '#C83F49'
+    }
+
+# Sunburst renderers: 'go' builds the plotly trace directly from the precomputed arrays, 'px' uses plotly express
+SUNBURST_RENDERERS = ('go', 'px')
+
+
+def sunburst_colors(letters):
     '''
 
     Parameters
     ----------
-    subdataset : pandas dataframe
-        Contains the data for the sunburst chart construction.
+    letters : list
+        First letter of the haplogroup of each sunburst node.
 
     Returns
     -------
-    popup : folium.Popup object
-        Contains an embedded sunburst chart in an HTML iframe.
+    colors : list
+        Colour of each node: HAPLOGROUP_COLORS, other letters get colours of the plotly template's
+        colour sequence in order of appearance (as assigned by plotly express).
 
     '''
 
-    # Defining custom colours to ensure Haplogroups maintain same colour across charts
-    color_map = {
-    'A': '#4863A0', 'B': 'orange', 'C': '#FBBBB9', 'D': '#CC7A8B', 'E': '#FBE7A1',
-    'G': '#BDF516', 'H': '#348781', 'I': '#654321', 'J': '#C83F49', 'K': '#9F000F',
-    'L': '#004225', 'M': '#FEF250', 'N': '#46C7C7', 'O': '#550A35', 'P': 'indigo',
-    'Q': '#C2E5D3', 'R': '#3B3131', 'T': '#667C26', 'U': '#9E7BFF', 'W': '#736F6E',
-    'X': '#C83F49'
-    }
-    
-    # Create sunburst
-    sunburst = px.sunburst(subdataset, 
-                           path=['first_letter', 'first_two_letters', 'first_three_letters', 'first_five_letters'],
-                           maxdepth=3,
-                           color='first_letter',
-                           color_discrete_map=color_map)
-    
+    import plotly.io as pio
+
+    # Colour sequence of the plotly template (as used by plotly express)
+    sequence = pio.templates[pio.templates.default].layout.colorway
+
+    letter_colors = dict(HAPLOGROUP_COLORS)
+    for letter in dict.fromkeys(letters):
+        if letter not in letter_colors:
+            letter_colors[letter] = sequence[len(letter_colors) % len(sequence)]
+
+    return [letter_colors[letter] for letter in letters]
+
+
+def sunburst_figure(sunburst_data, renderer='go'):
+    '''
+
+    Parameters
+    ----------
+    sunburst_data : dict
+        Sunburst hierarchy of a cluster (ids, labels, parents, values, letters), as returned by sunburst_arrays.
+    renderer : str
+        'go' (plotly graph_objects trace built from the arrays) or 'px' (plotly express).
+
+    Returns
+    -------
+    sunburst : plotly Figure object
+        The sunburst chart.
+
+    '''
+
+    # Create sunburst (hierarchy and counts precomputed, see haplogroup_count_matrix)
+    if renderer == 'px':
+        import plotly.express as px
+        sunburst = px.sunburst(ids=sunburst_data['ids'],
+                               names=sunburst_data['labels'],
+                               parents=sunburst_data['parents'],
+                               values=sunburst_data['values'],
+                               branchvalues='total',
+                               maxdepth=3,
+                               color=sunburst_data['letters'],
+                               color_discrete_map=HAPLOGROUP_COLORS)
+    else:
+        import plotly.graph_objects as go
+        sunburst = go.Figure(go.Sunburst(ids=sunburst_data['ids'],
+                                         labels=sunburst_data['labels'],
+                                         parents=sunburst_data['parents'],
+                                         values=sunburst_data['values'],
+                                         branchvalues='total',
+                                         maxdepth=3,
+                                         marker=dict(colors=sunburst_colors(sunburst_data['letters']))))
+
     # Set hover-over labels
     sunburst.update_traces(hovertemplate="%{value}<br>%{percentRoot:.0%}")
-    
+
     # Shift position to the right
     sunburst.update_layout(margin=dict(t=0, l=110, r=0, b=0))
-   
-    # Add legend
-    popup_text = f'{cluster_countries}<br>{total_indivs} individuals<br>{cluster_range}'
 
-    # Create sunburst html 
-    html = (
+    return sunburst
+
+
+def create_Sunburst(sunburst_data, popup_text, renderer='go'):
+    '''
+
+    Parameters
+    ----------
+    sunburst_data : dict
+        Sunburst hierarchy of a cluster (ids, labels, parents, values, letters), as returned by sunburst_arrays.
+    popup_text : str
+        Legend of the chart (countries, number of individuals and BP range of the cluster).
+    renderer : str
+        Sunburst renderer, see sunburst_figure.
+
+    Returns
+    -------
+    popup : folium.Popup object
+        Contains an embedded sunburst chart in an HTML iframe.
+
+    '''
+
+    return iframe_popup(sunburst_html(sunburst_data, popup_text, renderer))
+
+
+def sunburst_html(sunburst_data, popup_text, renderer='go'):
+    '''
+
+    Returns
+    -------
+    html : str
+        Html of the sunburst chart (loading plotly.js from the plotly CDN) with its legend,
+        for iframe_popup (parameters as create_Sunburst).
+
+    '''
+
+    import plotly.io as pio
+
+    # Create sunburst
+    sunburst = sunburst_figure(sunburst_data, renderer)
+
+    # Create sunburst html with legend
+    return (
         pio.to_html(sunburst, full_html=False, include_plotlyjs="cdn", config={'displaylogo': False,'displayModeBar': False}) 
         + f"<div style='position: absolute; left: 0px; top: 0px; font-family: Arial; font-size: 17px'>"
         + f"<h4>{popup_text}</h4></div>"
         )
 
+
+def iframe_popup(html):
+    '''
+
+    Returns
+    -------
+    popup : folium.Popup object
+        Contains the html (see sunburst_html) in an HTML iframe.
+
+    '''
+
+    import folium
+    import branca
+
     # Create iframe and popup and embed sunburst html
     iframe = branca.element.IFrame(html=html, width=380, height=260)
     popup = folium.Popup(iframe, max_width=380)
@@ -122,411 +308,3085 @@ def create_Sunburst(subdataset):
     return popup
 
 
+def render_popup(task):
+    '''
 
-###############################################################################
+    Parameters
+    ----------
+    task : tuple
+        Popup mode ('iframe' or 'shared'), sunburst_data, popup_text and renderer of a cluster's popup.
 
-# Import data and error checks:
+    Returns
+    -------
+    rendered : str or dict
+        Html of the popup's iframe (see sunburst_html), or its chart data (see sunburst_figure_spec).
+
+    '''
 
-# Check of input argument number
-if len(sys.argv) > 6:
-    print("Error: Too many arguments. Please only provide the AADR excel annotations file and optionally requested cluster numbers.\nProgram terminated.")
-    exit()
+    popup_mode, sunburst_data, popup_text, renderer = task
+    if popup_mode == 'iframe':
+        return sunburst_html(sunburst_data, popup_text, renderer)
 
-# Check of input file title
-if sys.argv[-1] == "AADR Annotations 2025.xlsx":
-    annotations = pd.read_excel(sys.argv[-1])
-else:
-    print('Error: Please provide the correct file ("AADR Annotations 2025.xlsx").\nProgram terminated')
-    exit()
+    return sunburst_figure_spec(sunburst_figure(sunburst_data, renderer))
 
 
+def render_popups(tasks, jobs=1):
+    '''
 
-###################################################################################
+    Parameters
+    ----------
+    tasks : list
+        Popups to render, see render_popup.
+    jobs : int
+        Number of worker processes rendering the popups (in this process if 1).
 
-# Cluster flags parser and flag input checks:
+    Returns
+    -------
+    rendered : list
+        Rendered popups (see render_popup), in the order of the tasks.
 
-# Set up argument parser
-parser = argparse.ArgumentParser(description="Specify cluster numbers for Y and mt")
+    '''
 
-# Add input file as a positional argument
-parser.add_argument('input_file', type=str, help="AADR Annotations 2025.xlsx")
+    if jobs == 1 or len(tasks) < 2:
+        return [render_popup(task) for task in tasks]
 
-# Give error if no integer is given after a flag
-try:
-    # Define cluster arguments with optional flags
-    parser.add_argument('--cluster_Y', type=int, default=150, help='Cluster number for Y (default: 150)')
-    parser.add_argument('--cluster_mt', type=int, default=350, help='Cluster number for mt (default: 350)')
-    # Parse arguments
-    args = parser.parse_args()
-except:
-    print('Error: Please provide an integer between 5 and 500 following the --cluster flags.\nProgram terminated')
-    exit()
+    from concurrent.futures import ProcessPoolExecutor
 
-# Check if cluster numbers are within restricted range
-if not (5 <= args.cluster_Y <= 500):
-    print("Error: Cluster number for Y must be between 5 and 500.\nProgram terminated.")
-    exit()
+    # Import plotly before starting the workers (inherited by forked workers instead of imported by each)
+    import plotly.graph_objects
+    import plotly.io
 
-if not (5 <= args.cluster_mt <= 500):
-    print("Error: Cluster number for mt must be between 5 and 500.\nProgram terminated.")
-    exit()
+    # A few chunks per worker (fewer transfers between the processes, balanced load), results in task order
+    chunksize = max(1, len(tasks) // (4 * jobs))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(render_popup, tasks, chunksize=chunksize))
 
 
 
 ###############################################################################
 
-# Modify annotation file data:
-    
-### Coloumns
-# Filter out irrelevant coloumns
-annotations = annotations.drop(columns=[
-    "#",
-    "Genetic ID",
-    "Master ID",
-    "Skeletal code",
-    "Skeletal element",
-    "Year data from this individual was first published [for a present-day individuals we give the data of the data reported here; missing GreenScience 2010 (Vi33.15, Vi33.26), Olalde2018 (I2657), RasmussenNature2010 (Australian)]",
-    "Publication",
-    "Method for Determining Date; unless otherwise specified, calibrations use 95.4% intervals from OxCal v4.4.2 Bronk Ramsey (2009); r5; Atmospheric data from Reimer et al (2020)", 
-    "Date standard deviation in BP [OxCal sigma for a direct radiocarbon date, and standard deviation of the uniform distribution between the two bounds for a contextual date]",
-    "Full Date One of two formats. (Format 1) 95.4% CI calibrated radiocarbon age (Conventional Radiocarbon Age BP, Lab number) e.g. 2624-2350 calBCE (3990±40 BP, Ua-35016). (Format 2) Archaeological context range, e.g. 2500-1700 BCE",
-    "Age at Death from physical anthropology",
-    "Group ID",
-    "Locality",
-    "Pulldown Strategy",
-    "Data source",
-    "No. Libraries",
-    "1240k coverage (taken from original pulldown where possible)",
-    "SNPs hit on autosomal targets (Computed using easystats on 1240k snpset)",
-    "SNPs hit on autosomal targets (Computed using easystats on HO snpset)",
-    "Family ID and position within family",
-    "Y haplogroup (manual curation in terminal mutation format)",
-    "mtDNA coverage (merged data)",
-    "mtDNA match to consensus if >2x (merged data)",
-    "Damage rate in first nucleotide on sequences overlapping 1240k targets (merged data)",
-    "Sex ratio [Y/(Y+X) counts] (merged data)",
-    "Library type (minus=no.damage.correction, half=damage.retained.at.last.position, plus=damage.fully.corrected, ds=double.stranded.library.preparation, ss=single.stranded.library.preparation)",
-    "Libraries",
-    "ASSESSMENT",
-    'ASSESSMENT WARNINGS (Xcontam interval is listed if lower bound is >0.005, "QUESTIONABLE" if lower bound is 0.01-0.02, "QUESTIONABLE_CRITICAL" or "FAIL" if lower bound is >0.02) (mtcontam confidence interval is listed if coverage >2 and upper bound is <0.'
-    ])
-
-# Rename coloumns
-annotations = annotations.rename(columns={
-    'Date mean in BP in years before 1950 CE [OxCal mu for a direct radiocarbon date, and average of range for a contextual date]':'Mean BP',
-    'Political Entity':'Country',
-    'Lat.':'Lat',
-    'Long.':'Long',
-    'Y haplogroup (manual curation in ISOGG format)': 'Y haplogroup',
-    'mtDNA haplogroup if >2x or published':'mtDNA haplogroup'
-    })
-
-
-### Countries
-# Change misspelled and long country names
-annotations['Country'] = annotations['Country'].replace({'China ':'China', 
-                                                         'Gernamy':'Germany', 
-                                                         'Turkey ':'Turkey',
-                                                         'Federated States of Micronesia':'Micronesia'
-                                                         })
-
-
-### BP
-# Remove modern samples (BP=0)
-annotations = annotations[annotations["Mean BP"] != 0]
-
-# Add age coloumn (translation of BP to BC and AD based on Present=1950)
-annotations["Age"] = np.where(
-    annotations["Mean BP"] >= 1950, 
-    (annotations["Mean BP"] - 1949).astype(str) + " BC",       # Convert to BC
-    (1950 - annotations["Mean BP"]).astype(str) + " AD"        # Convert to AD
-)
-
-
-### Coordinates
-# Remove missing Lat and Long coordinates
-annotations = annotations[annotations["Lat"] != ".."]
-annotations = annotations[annotations["Long"] != ".."]
-
-# Remove NA values for Lat and Long
-annotations = annotations.dropna(subset=["Lat", "Long"])
-
-# Round Lat and Long values to 2 decimal points
-annotations[["Lat", "Long"]] = annotations[["Lat", "Long"]].map(lambda x: round(x, 2))
-
-
-### Haplogroups
-# Convert haplogroup entries to strings
-annotations["Y haplogroup"] = annotations["Y haplogroup"].astype(str)
-annotations["mtDNA haplogroup"] = annotations["mtDNA haplogroup"].astype(str)
-
-# Remove N/A and empty haplogroup entries
-annotations = annotations[~annotations["Y haplogroup"].str.contains("n/a|na|NaN|not|Likely", na=False, regex=True)]
-annotations = annotations[~annotations["mtDNA haplogroup"].str.contains("n/a|na|NaN|not|Likely", na=False, regex=True)]
-annotations = annotations[annotations["Y haplogroup"].str.strip().ne('')]
-annotations = annotations[annotations["mtDNA haplogroup"].str.strip().ne('')]
-
-# Remove haplogroup naming additions
-annotations["Y haplogroup"] = annotations["Y haplogroup"].str.replace(r"[+\/\(\)'~@\-or\s].*", "", regex=True)
-annotations["mtDNA haplogroup"] = annotations["mtDNA haplogroup"].str.replace(r"[+\/\(\)'~@\-or\s].*", "", regex=True)
-
-
-### Y and mt data and info
-# Create separate tables for Y and mt data sets
-annotations_Y = annotations.drop(columns=["mtDNA haplogroup"])
-annotations_mt = annotations.drop(columns=["Y haplogroup"])
-
-# Remove unknown haplogroups (storing the number of unknowns)
-# Y
-Y_unknowns_count = annotations_Y['Y haplogroup'].str.contains(r'\.\.').sum() 
-annotations_Y = annotations_Y[annotations_Y["Y haplogroup"] != '..']
-# mt
-mt_unknowns_count = annotations_mt['mtDNA haplogroup'].str.contains(r'\.\.').sum()
-annotations_mt = annotations_mt[annotations_mt["mtDNA haplogroup"] != '..']
-
-# Most recent and oldest sample ages
-# Y
-youngest_Y = annotations_Y['Mean BP'].min()
-oldest_Y = annotations_Y['Mean BP'].max()
-# mt
-youngest_mt = annotations_mt['Mean BP'].min()
-oldest_mt = annotations_mt['Mean BP'].max()
-
-
-### BP ranges
-# Pre-grouping by BP range groups of 500
-annotations['BP range'] = ((annotations['Mean BP'] // 500) * 500 + 1).astype(str) + '-' + ((annotations['Mean BP'] // 500 + 1) * 500).astype(str)
-annotations_Y['BP range'] = ((annotations_Y['Mean BP'] // 500) * 500 + 1).astype(str) + '-' + ((annotations_Y['Mean BP'] // 500 + 1) * 500).astype(str)
-annotations_mt['BP range'] = ((annotations_mt['Mean BP'] // 500) * 500 + 1).astype(str) + '-' + ((annotations_mt['Mean BP'] // 500 + 1) * 500).astype(str)
-
-# Check for number of individuals per group
-# Y
-bp_counts = annotations_Y["BP range"].value_counts()
-sorted_bp_counts = bp_counts.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
-# mt
-bp_counts = annotations_mt["BP range"].value_counts()
-sorted_bp_counts = bp_counts.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
-
-# Grouping by extended BP range groups
-new_bp_ranges = [1, 1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000, 11000, 44500]
-bp_labels = ["1-1000", "1001-2000", "2001-3000", "3001-4000", "4001-5000", "5001-6000", "6001-7000", "7001-8000", "8001-11000", "11001-44500"]
-annotations["BP range"] = pd.cut(annotations["Mean BP"], bins=new_bp_ranges, labels=bp_labels, right=True)
-annotations_Y["BP range"] = pd.cut(annotations_Y["Mean BP"], bins=new_bp_ranges, labels=bp_labels, right=True)
-annotations_mt["BP range"] = pd.cut(annotations_mt["Mean BP"], bins=new_bp_ranges, labels=bp_labels, right=True)
-
-# Check for number of individuals per new group
-# Y
-bp_counts_Y = annotations_Y["BP range"].value_counts()
-sorted_bp_counts_Y = bp_counts_Y.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
-# mt
-bp_counts_mt = annotations_mt["BP range"].value_counts()
-sorted_bp_counts_mt = bp_counts_mt.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
-
-# List of BP range categories for marker tags
-bp_range_categories = annotations["BP range"].dropna().drop_duplicates().tolist()
-
-
-### Haplogroup subcategories
-# Subgrouping: 1, 2, 3, and 5 letters
-# Y
-annotations_Y['first_letter'] = annotations_Y['Y haplogroup'].str[:1]
-annotations_Y['first_two_letters'] = annotations_Y['Y haplogroup'].str[:2]
-annotations_Y['first_three_letters'] = annotations_Y['Y haplogroup'].str[:3]
-annotations_Y['first_five_letters'] = annotations_Y['Y haplogroup'].str[:5]
-# mt
-annotations_mt['first_letter'] = annotations_mt['mtDNA haplogroup'].str[:1]
-annotations_mt['first_two_letters'] = annotations_mt['mtDNA haplogroup'].str[:2]
-annotations_mt['first_three_letters'] = annotations_mt['mtDNA haplogroup'].str[:3]
-annotations_mt['first_five_letters'] = annotations_mt['mtDNA haplogroup'].str[:5]
+# Functions for sunburst popups rendered in the map page:
+
+# Popup modes: 'iframe' embeds every sunburst chart as its own html document (loading plotly.js each),
+# 'shared' loads plotly.js once in the map page and renders the charts into plain divs when their popup opens,
+# 'lazy' only stores the haplogroup counts and metadata of the clusters and builds the charts in the browser,
+# 'sidecar' as lazy, but the markers and clusters are stored in separate files fetched when they are shown
+POPUP_MODES = ('iframe', 'shared', 'lazy', 'sidecar')
+
+# Plotly chart options of the popups
+PLOTLY_CONFIG = {'displaylogo': False, 'displayModeBar': False}
+
+# URLs of the sidecar files (see write_sidecar_files) of a layer's markers and a cluster
+SIDECAR_URLS_SCRIPT = string.Template("""<script>
+var hvDataDir = $data_dir;
+function hvMarkersUrl(layerName) { return hvDataDir + '/' + layerName + '/markers.json'; }
+function hvClusterUrl(layerName, clusterId) { return hvDataDir + '/' + layerName + '/' + clusterId + '.json'; }
+</script>""")
+
+# Renders the sunburst chart of an opened popup and frees it when the popup closes
+# ($figure: javascript expression of the chart (data and layout) of the popup's div, or a promise of it)
+POPUP_SCRIPT = string.Template("""<script>
+window.addEventListener('load', function () {
+    var map = $map_name;
+    map.on('popupopen', function (event) {
+        var div = event.popup.getElement().querySelector('.hv-sunburst');
+        if (!div) { return; }
+        Promise.resolve($figure).then(function (figure) {
+            if (!div.isConnected) { return; }
+            var layout = Object.assign({template: hvTemplate}, figure.layout);
+            Plotly.newPlot(div, figure.data, layout, $config);
+        });
+    });
+    map.on('popupclose', function (event) {
+        var div = event.popup.getElement().querySelector('.hv-sunburst');
+        if (div) { Plotly.purge(div); }
+    });
+});
+</script>""")
+
+# Creates the cluster markers of a layer (from the popup data, or fetched from the sidecar files when the
+# layer is shown) and builds the sunburst chart and legend of a cluster from its haplogroup counts
+# (lazy and sidecar popup mode), as add_cluster_markers, sunburst_figure and popup_legend do
+CLIENT_SUNBURST_SCRIPT = """<script>
+function hvClusterMarker(layerName, clusterId, cluster) {
+    return L.circleMarker(cluster.location, {
+        radius: 5, color: 'black', fill: true, fillOpacity: 1, fillColor: 'black', tags: cluster.tags
+    }).bindPopup(
+        "<div style='position: relative; width: 380px; height: 260px'>"
+        + "<div class='hv-sunburst' data-layer='" + layerName + "' data-cluster='" + clusterId + "' style='width: 100%; height: 100%'></div>"
+        + "<div class='hv-legend' style='position: absolute; left: 0px; top: 0px; font-family: Arial; font-size: 17px'></div></div>",
+        {maxWidth: 380}
+    );
+}
+
+function hvAddMarkers(layerName, featureGroup) {
+    var layer = hvLayers[layerName];
+    var clusters = layer.clusters;
+    if (!layer.levels) {
+        Object.keys(clusters).forEach(function (clusterId) {
+            hvClusterMarker(layerName, clusterId, clusters[clusterId]).addTo(featureGroup);
+        });
+        return;
+    }
+    // Zoom levels: one group of markers per level, the level of the current zoom is shown
+    var levelGroups = layer.levels.map(function (level) {
+        var levelGroup = L.layerGroup();
+        level.clusters.forEach(function (clusterId) {
+            var marker = hvClusterMarker(layerName, clusterId, clusters[clusterId]).addTo(levelGroup);
+            // Markers of a hidden level re-added to the map by the BP range filter remove themselves
+            marker.on('add', function () { if (!levelGroup._map) { marker.remove(); } });
+        });
+        return levelGroup;
+    });
+    function hvShowLevel() {
+        var shown = 0;
+        layer.levels.forEach(function (level, index) {
+            if (featureGroup._map.getZoom() >= level.min_zoom) { shown = index; }
+        });
+        levelGroups.forEach(function (levelGroup, index) {
+            if (index === shown && !featureGroup.hasLayer(levelGroup)) { featureGroup.addLayer(levelGroup); }
+            if (index !== shown && featureGroup.hasLayer(levelGroup)) { featureGroup.removeLayer(levelGroup); }
+        });
+    }
+    // Levels follow the zoom while the layer is on the map (this runs before the layer is added to the map,
+    // and the layer control removes and re-adds it)
+    function hvFollowZoom() {
+        featureGroup._map.on('zoomend', hvShowLevel);
+        hvShowLevel();
+    }
+    featureGroup.on('add', hvFollowZoom);
+    featureGroup.on('remove', function () { featureGroup._map.off('zoomend', hvShowLevel); });
+    if (featureGroup._map) { hvFollowZoom(); }
+}
+
+var hvFeatureGroups = {};
+
+function hvFetchMarkers(layerName, featureGroup) {
+    hvFeatureGroups[layerName] = featureGroup;
+    featureGroup.on('add', function () {
+        setTimeout(function () { hvLoadMarkers(layerName); }, 0);
+    });
+}
+
+function hvLoadMarkers(layerName) {
+    var featureGroup = hvFeatureGroups[layerName];
+    if (featureGroup.hvLoaded || !featureGroup._map) { return; }
+    var request = (featureGroup.hvRequest || 0) + 1;
+    featureGroup.hvLoaded = true;
+    featureGroup.hvRequest = request;
+    hvFetchJson(hvMarkersUrl(layerName)).then(function (markers) {
+        if (featureGroup.hvRequest !== request) { return; }
+        Object.keys(markers).forEach(function (clusterId) {
+            hvClusterMarker(layerName, clusterId, markers[clusterId]).addTo(featureGroup);
+        });
+    }).catch(function (error) {
+        featureGroup.hvLoaded = false;
+        console.error(error);
+    });
+}
+
+function hvReloadMarkers(layerName) {
+    var featureGroup = hvFeatureGroups[layerName];
+    featureGroup.clearLayers();
+    featureGroup.hvLoaded = false;
+    featureGroup.hvRequest = (featureGroup.hvRequest || 0) + 1;
+    hvLoadMarkers(layerName);
+}
+
+function hvFetchJson(url) {
+    return fetch(url).then(function (response) {
+        return response.json().then(function (body) {
+            if (!response.ok) { throw new Error(body.error || response.statusText); }
+            return body;
+        });
+    });
+}
+
+function hvLayerCluster(layerName, clusterId) {
+    var layer = hvLayers[layerName];
+    var cluster = layer.clusters[clusterId];
+    return Object.assign({}, cluster, {
+        ids: cluster.nodes.map(function (node) { return layer.ids[node]; }),
+        labels: cluster.nodes.map(function (node) { return layer.labels[node]; }),
+        parents: cluster.nodes.map(function (node) { return layer.parents[node]; }),
+        letters: cluster.nodes.map(function (node) { return layer.letters[node]; })
+    });
+}
+
+function hvFetchCluster(layerName, clusterId) {
+    return hvFetchJson(hvClusterUrl(layerName, clusterId));
+}
+
+function hvSunburstFigure(div, cluster) {
+    var letterColors = Object.assign({}, hvColors.letters);
+    var assigned = Object.keys(letterColors).length;
+    var colors = cluster.letters.map(function (letter) {
+        if (!(letter in letterColors)) {
+            letterColors[letter] = hvColors.colorway[assigned % hvColors.colorway.length];
+            assigned += 1;
+        }
+        return letterColors[letter];
+    });
+    div.parentNode.querySelector('.hv-legend').innerHTML = '<h4>' + cluster.countries.join('<br>') + '<br>'
+        + cluster.individuals + ' individuals<br>' + cluster.bp_range + '</h4>';
+    return {
+        data: [{type: 'sunburst', ids: cluster.ids, labels: cluster.labels, parents: cluster.parents,
+                values: cluster.values, branchvalues: 'total', maxdepth: 3, marker: {colors: colors},
+                hovertemplate: '%{value}<br>%{percentRoot:.0%}'}],
+        layout: {margin: {t: 0, l: 110, r: 0, b: 0}}
+    };
+}
+</script>"""
+
+
+def create_sunburst_div(layer, cluster_id, popup_text):
+    '''
 
+    Parameters
+    ----------
+    layer : str
+        Layer name ('Y' or 'mt').
+    cluster_id : int
+        Cluster of the popup.
+    popup_text : str
+        Legend of the chart (countries, number of individuals and BP range of the cluster).
 
+    Returns
+    -------
+    popup : folium.Popup object
+        Contains an empty div for the sunburst chart (rendered when the popup opens) and the legend.
 
-###############################################################################
+    '''
 
-# Initialize map and set starting conditions:
-m = folium.Map(location=[30,20], 
-               tiles="Esri.WorldImagery", 
-               zoom_start=2.5, 
-               min_zoom=2, 
-               max_zoom=7, 
-               max_bounds=True)
+    import folium
 
+    html = (
+        f"<div style='position: relative; width: 380px; height: 260px'>"
+        + f"<div class='hv-sunburst' data-layer='{layer}' data-cluster='{cluster_id}' style='width: 100%; height: 100%'></div>"
+        + f"<div class='hv-legend' style='position: absolute; left: 0px; top: 0px; font-family: Arial; font-size: 17px'>"
+        + f"<h4>{popup_text}</h4></div></div>"
+        )
 
+    return folium.Popup(html, max_width=380)
 
-###############################################################################
 
-# Set group layers to separate Y and mt markers with interactive map buttons:
-    
-# Layers
-fg_Y = folium.FeatureGroup(name='Y')
-fg_mt = folium.FeatureGroup(name='mtDNA')
-m.add_child(fg_Y)
-m.add_child(fg_mt)
+def sunburst_figure_spec(sunburst):
+    '''
 
-# Button
-GroupedLayerControl(
-    groups={'Haplogroups': [fg_Y, fg_mt]},
-    collapsed=False,
-).add_to(m)
+    Parameters
+    ----------
+    sunburst : plotly Figure object
+        Sunburst chart, as returned by sunburst_figure.
+
+    Returns
+    -------
+    figure : dict
+        Data and layout of the chart, without the plotly template (shared by all charts in the map page).
 
+    '''
 
+    figure = sunburst.to_plotly_json()
+    figure['layout'].pop('template', None)
 
-###############################################################################
+    return figure
 
-# K means clustering:
 
-# Table of all coordinate combinations
-lat_long_locations_Y = annotations_Y[[annotations_Y.columns[2], annotations_Y.columns[3]]].drop_duplicates()
-lat_long_locations_mt = annotations_mt[[annotations_mt.columns[2], annotations_mt.columns[3]]].drop_duplicates()
+def marker_record(cluster):
+    '''
 
-# Convert lat_long to numpy arrays
-coords_Y = np.array(lat_long_locations_Y[[annotations_Y.columns[2], annotations_Y.columns[3]]])
-coords_mt = np.array(lat_long_locations_mt[[annotations_mt.columns[2], annotations_mt.columns[3]]])
+    Returns
+    -------
+    record : dict
+        Location (cluster center) and tags (BP ranges) of a cluster's marker (row of the cluster metadata table).
 
-# Set k (cluster numbers) based on user input
-n_clusters_Y = args.cluster_Y
-n_clusters_mt = args.cluster_mt
+    '''
 
-# Fit KMeans
-kmeans_Y = KMeans(n_clusters=n_clusters_Y, random_state=42, n_init=10).fit(coords_Y)
-kmeans_mt = KMeans(n_clusters=n_clusters_mt, random_state=42, n_init=10).fit(coords_mt)
+    return {'location': [float(cluster["Lat"]), float(cluster["Long"])], 'tags': list(cluster["BP ranges"])}
 
-# Add cluster labels
-lat_long_locations_Y["Cluster"] = kmeans_Y.labels_
-lat_long_locations_mt["Cluster"] = kmeans_mt.labels_
 
+def lazy_cluster_record(cluster, counts, cluster_id):
+    '''
 
+    Parameters
+    ----------
+    cluster : pandas series
+        Row of the cluster metadata table (see cluster_metadata).
+    counts : scipy.sparse csr_matrix
+        Haplogroup counts per cluster, as returned by haplogroup_count_matrix.
+    cluster_id : int
+        Cluster (row of counts).
 
-###############################################################################
+    Returns
+    -------
+    record : dict
+        Marker location and tags (BP ranges), legend data (countries, individuals, BP range) and haplogroup
+        counts (node indices and values) of the cluster, from which the browser builds its marker and popup
+        (lazy popup mode).
 
-# Add markers with popups to map - Y haplogroups:
+    '''
 
-# Loop through clusters
-for cluster_id in range(n_clusters_Y):
-    cluster_points = lat_long_locations_Y[lat_long_locations_Y["Cluster"] == cluster_id]
+    row = counts.getrow(cluster_id)
 
-    # Get cluster center
-    lat, long = kmeans_Y.cluster_centers_[cluster_id]
+    return {
+        **marker_record(cluster),
+        'countries': list(cluster["Countries"]),
+        'individuals': int(cluster["Individuals"]),
+        'bp_range': cluster_bp_range(cluster),
+        'nodes': row.indices.tolist(),
+        'values': row.data.tolist()
+        }
 
-    # Subset cluster individuals
-    subset = annotations_Y[
-        annotations_Y[[annotations_Y.columns[2], annotations_Y.columns[3]]]
-        .apply(tuple, axis=1)
-        .isin(cluster_points[[annotations_Y.columns[2], annotations_Y.columns[3]]].apply(tuple, axis=1))
-        ]
-    total_indivs = subset.shape[0]
 
-  # Find unique subset BP ranges
-    bp_ranges = subset['BP range'].unique()
-    bp_ranges = sorted(subset['BP range'].unique(), key=lambda x: int(x.split('-')[0]))
-    cluster_first_bp = bp_ranges[0].split("-")[0]
-    cluster_last_bp = bp_ranges[-1].split("-")[1]
-    if cluster_first_bp == cluster_last_bp:
-        cluster_range = f'{bp_ranges[0]} BP'
-    else:
-        cluster_range = f'{cluster_first_bp}-{cluster_last_bp} BP'
-    countries = subset['Country'].unique()
-    if len(countries) < 2:
-        cluster_countries = countries[0]
-    else:
-        cluster_countries = f'{"<br>".join(countries)}'  
-        
-    # Create popup and add marker
-    popup = create_Sunburst(subset)
-    folium.CircleMarker(
-        location=[lat, long],  
-        radius=5,  
-        color="black",
-        fill=True,
-        fill_opacity=1,
-        fill_color="black",  
-        popup=popup,
-        tags=bp_ranges
-    ).add_to(fg_Y)
+def lazy_layer_data(nodes, cluster_records):
+    '''
 
-    
+    Returns
+    -------
+    layer_data : dict
+        Node table of a layer (ids, labels, parents, letters, see haplogroup_count_matrix)
+        and its cluster records (see lazy_cluster_record) by cluster id.
 
-###############################################################################
+    '''
 
-# Add markers with popups to map - mt haplogroups:
+    layer_data = {column: nodes[column].tolist() for column in ('id', 'label', 'parent', 'letter')}
+    layer_data = {f'{column}s': values for column, values in layer_data.items()}
+    layer_data['clusters'] = cluster_records
 
-# Loop through clusters 
-for cluster_id in range(n_clusters_mt):
-    cluster_points = lat_long_locations_mt[lat_long_locations_mt["Cluster"] == cluster_id]
+    return layer_data
 
-    # Get cluster center
-    lat, long = kmeans_mt.cluster_centers_[cluster_id]
 
-    # Subset cluster individuals
-    subset = annotations_mt[
-        annotations_mt[[annotations_mt.columns[2], annotations_mt.columns[3]]]
-        .apply(tuple, axis=1)
-        .isin(cluster_points[[annotations_mt.columns[2], annotations_mt.columns[3]]].apply(tuple, axis=1))
-        ]
-    total_indivs = subset.shape[0]
-    
-    # Find unique subset BP ranges
-    bp_ranges = subset['BP range'].unique()
-    bp_ranges = sorted(subset['BP range'].unique(), key=lambda x: int(x.split('-')[0]))
-    cluster_first_bp = bp_ranges[0].split("-")[0]
-    cluster_last_bp = bp_ranges[-1].split("-")[1]
-    if cluster_first_bp == cluster_last_bp:
-        cluster_range = f'{bp_ranges[0]} BP'
+def add_zoom_levels(layer_data, levels):
+    '''
+
+    Adds the coarser cluster levels of a layer (see cluster_hierarchy) to its layer data (see lazy_layer_data):
+    their cluster records (ids "<level>:<cluster id>") and per level, coarsest first, the zoom from which it is
+    shown and its cluster ids (the given clusters are the finest level).
+
+    '''
+
+    finest_ids = [str(cluster_id) for cluster_id in layer_data['clusters']]
+    zoom_levels = []
+    for level, (metadata, counts) in enumerate(levels):
+        cluster_ids = [f"{level}:{cluster_id}" for cluster_id in metadata.index]
+        for level_id, (cluster_id, cluster) in zip(cluster_ids, metadata.iterrows()):
+            layer_data['clusters'][level_id] = lazy_cluster_record(cluster, counts, cluster_id)
+        zoom_levels.append({'min_zoom': ZOOM_LEVEL_FIRST_ZOOM + level, 'clusters': cluster_ids})
+    zoom_levels.append({'min_zoom': ZOOM_LEVEL_FIRST_ZOOM + len(levels), 'clusters': finest_ids})
+    layer_data['levels'] = zoom_levels
+
+
+def sidecar_cluster_record(cluster, counts, nodes, cluster_id):
+    '''
+
+    Returns
+    -------
+    record : dict
+        As lazy_cluster_record, with the sunburst hierarchy of the cluster (see sunburst_arrays)
+        instead of node indices (sidecar popup mode and map server).
+
+    '''
+
+    record = lazy_cluster_record(cluster, counts, cluster_id)
+    del record['nodes']
+    record.update(sunburst_arrays(counts, nodes, cluster_id))
+
+    return record
+
+
+def sidecar_dir(output):
+    '''
+
+    Returns
+    -------
+    data_dir : str
+        Directory of the sidecar files of a map file (e.g. map_data for map.html).
+
+    '''
+
+    return f"{os.path.splitext(output)[0]}_data"
+
+
+def write_sidecar_files(data_dir, popup_data):
+    '''
+
+    Writes the sidecar files of the map: per layer a markers.json file (location and tags of the
+    clusters) and a <cluster id>.json file per cluster (see sidecar_cluster_record).
+    Files of an earlier map with the same name are replaced.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory of the sidecar files, see sidecar_dir.
+    popup_data : dict
+        Cluster records (see sidecar_cluster_record) by cluster id, by layer name.
+
+    '''
+
+    for layer, records in popup_data.items():
+        layer_dir = os.path.join(data_dir, layer)
+        if os.path.isdir(layer_dir):
+            shutil.rmtree(layer_dir)
+        os.makedirs(layer_dir)
+
+        markers = {cluster_id: {key: record[key] for key in ('location', 'tags')} for cluster_id, record in records.items()}
+        with open(os.path.join(layer_dir, "markers.json"), "w", encoding="utf-8") as file:
+            json.dump(markers, file, separators=(",", ":"))
+        for cluster_id, record in records.items():
+            cluster = {key: value for key, value in record.items() if key not in ('location', 'tags')}
+            with open(os.path.join(layer_dir, f"{cluster_id}.json"), "w", encoding="utf-8") as file:
+                json.dump(cluster, file, separators=(",", ":"))
+
+
+def add_client_markers(feature_group, layer, popup_mode):
+    '''
+
+    Adds the script creating the cluster markers of a layer in the browser to the feature group
+    (from the popup data in the map page ('lazy', see add_page_popups), or when the layer is shown
+    from the sidecar files ('sidecar', see write_sidecar_files) or the map server ('server', see serve_map)).
+
+    '''
+
+    from branca.element import MacroElement
+    from jinja2 import Template
+
+    markers = MacroElement()
+    markers._template = Template(
+        "{% macro script(this, kwargs) %}"
+        + f"{'hvAddMarkers' if popup_mode == 'lazy' else 'hvFetchMarkers'}({json.dumps(layer)}, {{{{ this._parent.get_name() }}}});"
+        + "{% endmacro %}")
+    feature_group.add_child(markers)
+
+
+def script_json(data):
+    '''
+
+    Returns
+    -------
+    text : str
+        JSON text of the data (plotly objects included) that can be placed in an html script element.
+
+    '''
+
+    from plotly.io.json import to_json_plotly
+
+    return to_json_plotly(data).replace("</", "<\\/")
+
+
+def page_element(html):
+    '''
+
+    Returns
+    -------
+    element : folium.Element object
+        Element inserting the html (e.g. a script) into the map page as it is (not as a jinja template).
+
+    '''
+
+    import folium
+
+    element = folium.Element("{{ this.html }}")
+    element.html = html
+
+    return element
+
+
+def add_plotly(m, offline=False):
+    '''
+
+    Adds plotly.js (from the plotly CDN, or inlined if offline) and the plotly template (once) to the map page.
+
+    '''
+
+    import plotly.io as pio
+    from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+    root = m.get_root()
+    if offline:
+        root.header.add_child(page_element(f'<script type="text/javascript">{get_plotlyjs()}</script>'))
     else:
-        cluster_range = f'{cluster_first_bp}-{cluster_last_bp} BP'
-    countries = subset['Country'].unique()
-    if len(countries) < 2:
-        cluster_countries = countries[0]
+        root.header.add_child(page_element(f'<script src="https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js" charset="utf-8"></script>'))
+    template = pio.templates[pio.templates.default].to_plotly_json()
+    root.html.add_child(page_element(f"<script>var hvTemplate = {script_json(template)};</script>"))
+
+
+def add_page_popups(m, popup_data, popup_mode, offline=False, data_dir=None):
+    '''
+
+    Adds plotly.js, the popup data and the popup script to the map page.
+
+    Parameters
+    ----------
+    m : folium.Map object
+        The map.
+    popup_data : dict
+        By layer name: the sunburst charts by cluster id, as returned by sunburst_figure_spec ('shared'),
+        or the layer data, as returned by lazy_layer_data ('lazy'), not used in 'sidecar' popup mode.
+    popup_mode : str
+        'shared', 'lazy' or 'sidecar', see POPUP_MODES, or 'server' (page of the map server, see server_page).
+    offline : bool
+        Inline plotly.js instead of loading it from the plotly CDN.
+    data_dir : str
+        Directory of the sidecar files ('sidecar'), see sidecar_dir.
+
+    '''
+
+    import plotly.io as pio
+
+    add_plotly(m, offline)
+    root = m.get_root()
+    if popup_mode in ('lazy', 'sidecar', 'server'):
+        colors = {'letters': HAPLOGROUP_COLORS, 'colorway': list(pio.templates[pio.templates.default].layout.colorway)}
+        root.html.add_child(page_element(f"<script>var hvColors = {script_json(colors)};</script>"))
+        root.html.add_child(page_element(CLIENT_SUNBURST_SCRIPT))
+    if popup_mode == 'lazy':
+        root.html.add_child(page_element(f"<script>var hvLayers = {script_json(popup_data)};</script>"))
+        figure = "hvSunburstFigure(div, hvLayerCluster(div.dataset.layer, div.dataset.cluster))"
+    elif popup_mode in ('sidecar', 'server'):
+        if popup_mode == 'sidecar':
+            root.html.add_child(page_element(SIDECAR_URLS_SCRIPT.substitute(data_dir=script_json(os.path.basename(data_dir)))))
+        figure = ("hvFetchCluster(div.dataset.layer, div.dataset.cluster).then(function (cluster) {"
+                  + " return hvSunburstFigure(div, cluster); })")
     else:
-        cluster_countries = f'{"<br>".join(countries)}'
-        
-    # Create popup and add marker
-    popup = create_Sunburst(subset)
-    folium.CircleMarker(
-        location=[lat, long],  
-        radius=5,  
-        color="black",
-        fill=True,
-        fill_opacity=1,
-        fill_color="black",  
-        popup=popup,
-        tags=bp_ranges
-    ).add_to(fg_mt)
+        root.html.add_child(page_element(f"<script>var hvSunbursts = {script_json(popup_data)};</script>"))
+        figure = "hvSunbursts[div.dataset.layer][div.dataset.cluster]"
+    root.html.add_child(page_element(POPUP_SCRIPT.substitute(map_name=m.get_name(), figure=figure,
+                                                               config=json.dumps(PLOTLY_CONFIG))))
 
 
 
 ###############################################################################
 
-# BP range filter:
-    
-# Sort BP range categories
-bp_range_categories_sorted = sorted(bp_range_categories, key=lambda x: int(x.split('-')[0]))
-# BP range tag-filter buttons
-TagFilterButton(bp_range_categories_sorted).add_to(m)
+# Functions for haplogroup counts per cluster:
+
+def haplogroup_count_matrix(samples, n_clusters):
+    '''
+
+    Parameters
+    ----------
+    samples : pandas dataframe
+        Cleaned Y or mt samples with cluster labels, as returned by label_samples.
+    n_clusters : int
+        Number of clusters.
+
+    Returns
+    -------
+    counts : scipy.sparse csr_matrix
+        Number of individuals per cluster (rows) and haplogroup hierarchy node (columns).
+    nodes : pandas dataframe
+        One row per hierarchy node (in column order of counts): id (path of the node, e.g. "H/H1/H1a"),
+        label, parent id ("" for first letters) and first letter of the haplogroup.
+
+    '''
 
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
 
+    # Node ids of every sample on each hierarchy level ("H", "H/H1", "H/H1/H1a", ...)
+    level_ids = [samples[HAPLOGROUP_PATH[0]].astype(str)]
+    for column in HAPLOGROUP_PATH[1:]:
+        level_ids.append(level_ids[-1] + "/" + samples[column].astype(str))
+    node_ids = pd.Categorical(pd.concat(level_ids, ignore_index=True))
 
-###############################################################################
+    # Count samples per cluster and node (each sample counts once on every level)
+    clusters = np.tile(samples["Cluster"].to_numpy(), len(HAPLOGROUP_PATH))
+    counts = sparse.csr_matrix((np.ones(len(node_ids), dtype=np.int64), (clusters, node_ids.codes)),
+                               shape=(n_clusters, len(node_ids.categories)))
 
-# Save and open map:
+    # Node table (label and parent from the id, parent ids stripped of a leading "/" as in plotly express)
+    ids = pd.Series(node_ids.categories, dtype=str)
+    nodes = pd.DataFrame({
+        'id': ids,
+        'label': ids.str.rsplit("/", n=1).str[-1],
+        'parent': ids.str.rpartition("/")[0].str.replace("^/", "", regex=True),
+        'letter': ids.str.split("/", n=1).str[0]
+        })
 
-m.save("map.html")
-os.system("map.html")
+    return counts, nodes
 
 
+def sunburst_arrays(counts, nodes, cluster_id):
+    '''
+
+    Parameters
+    ----------
+    counts, nodes
+        As returned by haplogroup_count_matrix.
+    cluster_id : int
+        Cluster (row of counts).
+
+    Returns
+    -------
+    sunburst_data : dict
+        Sunburst hierarchy of the cluster: node ids, labels, parents, values (number of individuals)
+        and letters (first letter, for the colours).
+
+    '''
+
+    row = counts.getrow(cluster_id)
+    cluster_nodes = nodes.iloc[row.indices]
+
+    return {
+        'ids': cluster_nodes['id'].tolist(),
+        'labels': cluster_nodes['label'].tolist(),
+        'parents': cluster_nodes['parent'].tolist(),
+        'values': row.data.tolist(),
+        'letters': cluster_nodes['letter'].tolist()
+        }
+
 
+def export_haplogroup_counts(counts, nodes, file_path):
+    '''
 
+    Writes the haplogroup counts per cluster (see haplogroup_count_matrix) to a csv file in long format
+    (one row per cluster and hierarchy node with at least one individual).
 
+    '''
 
+    import pandas as pd
 
+    counts = counts.tocoo()
+    pd.DataFrame({
+        'Cluster': counts.row,
+        'Node': nodes['id'].to_numpy()[counts.col],
+        'Individuals': counts.data
+        }).sort_values(['Cluster', 'Node']).to_csv(file_path, index=False)
 
 
 
+###############################################################################
 
+# Functions for loading the annotations file (with cache):
 
+# Bump when the layout of the cached table changes, so old cache files are ignored
+CACHE_SCHEMA_VERSION = 2
+DEFAULT_CACHE_DIR = ".haplogroup_cache"
 
+# Cache lookups of this run as (artifact, 'hit'/'miss', cache path), shown with --cache_report
+cache_events = []
 
 
+# Columns used by the program: internal name and pattern matching the AADR column header
+# (matched at the start of the header, case-insensitive, with whitespace collapsed)
+ANNOTATION_COLUMNS = {
+    'Mean BP': r'date mean in bp',
+    'Country': r'political entity',
+    'Lat': r'lat(\.|itude)?$',
+    'Long': r'long(\.|itude)?$',
+    'Y haplogroup': r'y haplogroup.*isogg',
+    'mtDNA haplogroup': r'mtdna haplogroup'
+    }
 
 
+# Supported input file extensions and their format
+INPUT_FORMATS = {
+    '.xlsx': 'excel',
+    '.xls': 'excel',
+    '.anno': 'tab',
+    '.tsv': 'tab',
+    '.csv': 'csv'
+    }
+
+
+def match_annotation_column(header):
+    '''
+
+    Parameters
+    ----------
+    header : str
+        Column header of the input file.
+
+    Returns
+    -------
+    name : str or None
+        Internal name of the column (key of ANNOTATION_COLUMNS), None for unused columns.
+
+    '''
+
+    normalized = ' '.join(str(header).split()).lower()
+    for name, pattern in ANNOTATION_COLUMNS.items():
+        if re.match(pattern, normalized):
+            return name
+
+    return None
+
+
+def select_annotation_columns(annotations):
+    '''
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Annotations table with the original column headers.
+
+    Returns
+    -------
+    annotations : pandas dataframe
+        Only the used columns, renamed to their internal names (in ANNOTATION_COLUMNS order).
+
+    '''
+
+    # First matching column per internal name
+    renames = {}
+    for header in annotations.columns:
+        name = match_annotation_column(header)
+        if name is not None and name not in renames.values():
+            renames[header] = name
+
+    missing = [name for name in ANNOTATION_COLUMNS if name not in renames.values()]
+    if missing:
+        raise ValueError(f"Column(s) not found in input file: {', '.join(missing)}")
+
+    return annotations[list(renames)].rename(columns=renames)[list(ANNOTATION_COLUMNS)]
+
+
+def import_feather():
+    '''
+
+    Returns
+    -------
+    feather : module or None
+        pyarrow.feather (optional dependency of the cache), None if pyarrow is not installed.
+
+    '''
+
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return None
+
+    return feather
+
+
+def file_digest(file_path):
+    '''
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the file to hash.
+
+    Returns
+    -------
+    digest : str
+        SHA-256 hex digest of the file content.
+
+    '''
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def missing_values_as_nan(annotations):
+    '''
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Annotations table read from a text or Feather file (missing text values may be None).
+
+    Returns
+    -------
+    annotations : pandas dataframe
+        The same table with missing text values as NaN, as read by pd.read_excel.
+
+    '''
+
+    import numpy as np
+
+    text_columns = annotations.columns[annotations.dtypes == object]
+    annotations[text_columns] = annotations[text_columns].fillna(np.nan)
+
+    return annotations
+
+
+def detect_input_format(file_path):
+    '''
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the AADR annotations file.
+
+    Returns
+    -------
+    input_format : str or None
+        'excel' (.xlsx, .xls), 'tab' (AADR .anno release files, .tsv) or 'csv' (.csv), None for other files.
+
+    '''
+
+    return INPUT_FORMATS.get(os.path.splitext(file_path)[1].lower())
+
+
+def read_annotations_file(file_path):
+    '''
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the AADR annotations file (.xlsx, .xls, .anno, .tsv or .csv).
+
+    Returns
+    -------
+    annotations : pandas dataframe
+        The used columns of the annotations table (see ANNOTATION_COLUMNS).
+
+    '''
+
+    import pandas as pd
+
+    input_format = detect_input_format(file_path)
+
+    # Excel: only parse the used columns
+    if input_format == 'excel':
+        annotations = pd.read_excel(file_path, usecols=lambda header: match_annotation_column(header) is not None)
+        return select_annotation_columns(annotations)
+
+    # Text: read the header line to find the used columns, then parse only those (with pyarrow's CSV engine if installed)
+    separator = '\t' if input_format == 'tab' else ','
+    headers = pd.read_csv(file_path, sep=separator, nrows=0).columns
+    used_headers = [header for header in headers if match_annotation_column(header) is not None]
+    annotations = pd.read_csv(file_path, sep=separator, usecols=used_headers, engine='pyarrow' if import_feather() is not None else 'c')
+
+    return missing_values_as_nan(select_annotation_columns(annotations))
+
+
+def load_annotations(file_path, cache_dir=DEFAULT_CACHE_DIR, refresh=False, digest=None):
+    '''
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the AADR annotations file.
+    cache_dir : str
+        Directory holding the columnar (Feather) copies of parsed annotation files.
+    refresh : bool
+        Re-parse the input file and overwrite its cached copy.
+    digest : str, optional
+        Precomputed file_digest of the input file.
+
+    Returns
+    -------
+    annotations : pandas dataframe
+        The used columns of the annotations table (see ANNOTATION_COLUMNS).
+
+    '''
+
+    import pandas as pd
+
+    # Without pyarrow there is no columnar format to cache into
+    feather = import_feather()
+    if feather is None:
+        return read_annotations_file(file_path)
+
+    # Cache file keyed on file content and cache layout
+    if digest is None:
+        digest = file_digest(file_path)
+    cache_file = os.path.join(cache_dir, f"annotations_{digest[:20]}_v{CACHE_SCHEMA_VERSION}.feather")
+
+    # Cache hit: memory-mapped load
+    if os.path.exists(cache_file) and not refresh:
+        cache_events.append(('annotations', 'hit', cache_file))
+        return missing_values_as_nan(feather.read_table(cache_file, memory_map=True).to_pandas())
+
+    # Cache miss: parse input file
+    cache_events.append(('annotations', 'miss', cache_file))
+    annotations = read_annotations_file(file_path)
+
+    # Store mixed-type columns (e.g. numbers and ".." in Lat.) as text, keeping missing values
+    cached = annotations.copy()
+    for column in cached.columns[cached.dtypes == object]:
+        cached[column] = cached[column].map(lambda x: x if pd.isna(x) else str(x))
+
+    # Write to a temporary file first so concurrent runs never read a partial cache file
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    feather.write_feather(cached, temp_file)
+    os.replace(temp_file, cache_file)
+
+    return annotations
+
+
+
+###############################################################################
+
+# Function for data preprocessing:
+def preprocess_annotations(annotations):
+    '''
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        The used columns of the AADR annotations table (internal column names, see ANNOTATION_COLUMNS).
+
+    Returns
+    -------
+    annotations_Y : pandas dataframe
+        Cleaned Y haplogroup samples with BP ranges and haplogroup subcategories.
+    annotations_mt : pandas dataframe
+        Cleaned mtDNA haplogroup samples with BP ranges and haplogroup subcategories.
+    bp_range_categories : list
+        BP range categories present in the data, used for the marker tags.
+
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    # Work on a copy, the loaded table stays unchanged
+    annotations = annotations.copy()
+
+
+    ### Countries
+    # Change misspelled and long country names
+    annotations['Country'] = annotations['Country'].replace({'China ':'China', 
+                                                             'Gernamy':'Germany', 
+                                                             'Turkey ':'Turkey',
+                                                             'Federated States of Micronesia':'Micronesia'
+                                                             })
+
+
+    ### BP
+    # Remove modern samples (BP=0)
+    annotations = annotations[annotations["Mean BP"] != 0]
+
+    # Add age coloumn (translation of BP to BC and AD based on Present=1950)
+    annotations["Age"] = np.where(
+        annotations["Mean BP"] >= 1950, 
+        (annotations["Mean BP"] - 1949).astype(str) + " BC",       # Convert to BC
+        (1950 - annotations["Mean BP"]).astype(str) + " AD"        # Convert to AD
+    )
+
+
+    ### Coordinates
+    # Remove missing Lat and Long coordinates
+    annotations = annotations[annotations["Lat"] != ".."]
+    annotations = annotations[annotations["Long"] != ".."]
+
+    # Remove NA values for Lat and Long
+    annotations = annotations.dropna(subset=["Lat", "Long"])
+
+    # Round Lat and Long values to 2 decimal points
+    annotations[["Lat", "Long"]] = annotations[["Lat", "Long"]].map(lambda x: round(float(x), 2))
+
+
+    ### Haplogroups
+    # Convert haplogroup entries to strings
+    annotations["Y haplogroup"] = annotations["Y haplogroup"].astype(str)
+    annotations["mtDNA haplogroup"] = annotations["mtDNA haplogroup"].astype(str)
+
+    # Remove N/A and empty haplogroup entries
+    annotations = annotations[~annotations["Y haplogroup"].str.contains("n/a|na|NaN|not|Likely", na=False, regex=True)]
+    annotations = annotations[~annotations["mtDNA haplogroup"].str.contains("n/a|na|NaN|not|Likely", na=False, regex=True)]
+    annotations = annotations[annotations["Y haplogroup"].str.strip().ne('')]
+    annotations = annotations[annotations["mtDNA haplogroup"].str.strip().ne('')]
+
+    # Remove haplogroup naming additions
+    annotations["Y haplogroup"] = annotations["Y haplogroup"].str.replace(r"[+\/\(\)'~@\-or\s].*", "", regex=True)
+    annotations["mtDNA haplogroup"] = annotations["mtDNA haplogroup"].str.replace(r"[+\/\(\)'~@\-or\s].*", "", regex=True)
+
+
+    ### Y and mt data and info
+    # Create separate tables for Y and mt data sets
+    annotations_Y = annotations.drop(columns=["mtDNA haplogroup"])
+    annotations_mt = annotations.drop(columns=["Y haplogroup"])
+
+    # Remove unknown haplogroups (storing the number of unknowns)
+    # Y
+    Y_unknowns_count = annotations_Y['Y haplogroup'].str.contains(r'\.\.').sum() 
+    annotations_Y = annotations_Y[annotations_Y["Y haplogroup"] != '..']
+    # mt
+    mt_unknowns_count = annotations_mt['mtDNA haplogroup'].str.contains(r'\.\.').sum()
+    annotations_mt = annotations_mt[annotations_mt["mtDNA haplogroup"] != '..']
+
+    # Most recent and oldest sample ages
+    # Y
+    youngest_Y = annotations_Y['Mean BP'].min()
+    oldest_Y = annotations_Y['Mean BP'].max()
+    # mt
+    youngest_mt = annotations_mt['Mean BP'].min()
+    oldest_mt = annotations_mt['Mean BP'].max()
+
+
+    ### BP ranges
+    # Pre-grouping by BP range groups of 500
+    annotations['BP range'] = ((annotations['Mean BP'] // 500) * 500 + 1).astype(str) + '-' + ((annotations['Mean BP'] // 500 + 1) * 500).astype(str)
+    annotations_Y['BP range'] = ((annotations_Y['Mean BP'] // 500) * 500 + 1).astype(str) + '-' + ((annotations_Y['Mean BP'] // 500 + 1) * 500).astype(str)
+    annotations_mt['BP range'] = ((annotations_mt['Mean BP'] // 500) * 500 + 1).astype(str) + '-' + ((annotations_mt['Mean BP'] // 500 + 1) * 500).astype(str)
+
+    # Check for number of individuals per group
+    # Y
+    bp_counts = annotations_Y["BP range"].value_counts()
+    sorted_bp_counts = bp_counts.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
+    # mt
+    bp_counts = annotations_mt["BP range"].value_counts()
+    sorted_bp_counts = bp_counts.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
+
+    # Grouping by extended BP range groups
+    new_bp_ranges = [1, 1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000, 11000, 44500]
+    bp_labels = ["1-1000", "1001-2000", "2001-3000", "3001-4000", "4001-5000", "5001-6000", "6001-7000", "7001-8000", "8001-11000", "11001-44500"]
+    annotations["BP range"] = pd.cut(annotations["Mean BP"], bins=new_bp_ranges, labels=bp_labels, right=True)
+    annotations_Y["BP range"] = pd.cut(annotations_Y["Mean BP"], bins=new_bp_ranges, labels=bp_labels, right=True)
+    annotations_mt["BP range"] = pd.cut(annotations_mt["Mean BP"], bins=new_bp_ranges, labels=bp_labels, right=True)
+
+    # Check for number of individuals per new group
+    # Y
+    bp_counts_Y = annotations_Y["BP range"].value_counts()
+    sorted_bp_counts_Y = bp_counts_Y.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
+    # mt
+    bp_counts_mt = annotations_mt["BP range"].value_counts()
+    sorted_bp_counts_mt = bp_counts_mt.sort_index(key=lambda x: x.str.extract(r'(\d+)')[0].astype(int))
+
+    # List of BP range categories for marker tags
+    bp_range_categories = annotations["BP range"].dropna().drop_duplicates().tolist()
+
+
+    ### Haplogroup subcategories
+    # Subgrouping: 1, 2, 3, and 5 letters
+    # Y
+    annotations_Y['first_letter'] = annotations_Y['Y haplogroup'].str[:1]
+    annotations_Y['first_two_letters'] = annotations_Y['Y haplogroup'].str[:2]
+    annotations_Y['first_three_letters'] = annotations_Y['Y haplogroup'].str[:3]
+    annotations_Y['first_five_letters'] = annotations_Y['Y haplogroup'].str[:5]
+    # mt
+    annotations_mt['first_letter'] = annotations_mt['mtDNA haplogroup'].str[:1]
+    annotations_mt['first_two_letters'] = annotations_mt['mtDNA haplogroup'].str[:2]
+    annotations_mt['first_three_letters'] = annotations_mt['mtDNA haplogroup'].str[:3]
+    annotations_mt['first_five_letters'] = annotations_mt['mtDNA haplogroup'].str[:5]
+
+    return annotations_Y, annotations_mt, bp_range_categories
+
+
+
+###############################################################################
+
+# Functions for the cleaned tables cache:
+
+def cleaning_rules_digest():
+    '''
+
+    Returns
+    -------
+    digest : str
+        SHA-256 hex digest of the preprocessing code and used columns, so edited cleaning rules invalidate cached tables.
+
+    '''
+
+    rules = inspect.getsource(preprocess_annotations) + repr(ANNOTATION_COLUMNS)
+
+    return hashlib.sha256(rules.encode('utf-8')).hexdigest()
+
+
+def load_cleaned_tables(file_path, cache_dir=DEFAULT_CACHE_DIR, refresh=False):
+    '''
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the AADR annotations file.
+    cache_dir : str
+        Directory holding the cached tables.
+    refresh : bool
+        Re-parse and re-clean the input file and overwrite the cached tables.
+
+    Returns
+    -------
+    annotations_Y, annotations_mt, bp_range_categories
+        As returned by preprocess_annotations.
+
+    '''
+
+    # Without pyarrow there is no columnar format to cache into
+    feather = import_feather()
+    if feather is None:
+        return preprocess_annotations(load_annotations(file_path))
+
+    # Cache directory keyed on file content, cleaning rules and cache layout
+    digest = file_digest(file_path)
+    cache_path = os.path.join(cache_dir, f"cleaned_{digest[:20]}_{cleaning_rules_digest()[:12]}_v{CACHE_SCHEMA_VERSION}")
+
+    # Cache hit: memory-mapped load of both tables
+    if os.path.isdir(cache_path) and not refresh:
+        cache_events.append(('cleaned tables', 'hit', cache_path))
+        annotations_Y = feather.read_table(os.path.join(cache_path, "Y.feather"), memory_map=True).to_pandas()
+        annotations_mt = feather.read_table(os.path.join(cache_path, "mt.feather"), memory_map=True).to_pandas()
+        with open(os.path.join(cache_path, "bp_range_categories.json")) as handle:
+            bp_range_categories = json.load(handle)
+        return annotations_Y, annotations_mt, bp_range_categories
+
+    # Cache miss: load (raw cache or input file) and preprocess
+    cache_events.append(('cleaned tables', 'miss', cache_path))
+    annotations = load_annotations(file_path, cache_dir=cache_dir, refresh=refresh, digest=digest)
+    annotations_Y, annotations_mt, bp_range_categories = preprocess_annotations(annotations)
+
+    # Write to a temporary directory first so concurrent runs never read partial tables
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    os.makedirs(temp_path, exist_ok=True)
+    feather.write_feather(annotations_Y, os.path.join(temp_path, "Y.feather"))
+    feather.write_feather(annotations_mt, os.path.join(temp_path, "mt.feather"))
+    with open(os.path.join(temp_path, "bp_range_categories.json"), 'w') as handle:
+        json.dump(bp_range_categories, handle)
+    if os.path.isdir(cache_path):
+        shutil.rmtree(cache_path)
+    try:
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # Another run stored the same tables in the meantime
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    return annotations_Y, annotations_mt, bp_range_categories
+
+
+def report_cache():
+    '''
+
+    Prints the cache lookups (hits and misses) of this run.
+
+    '''
+
+    if import_feather() is None:
+        print("Cache report: input file cache disabled (pyarrow is not installed)")
+    for artifact, outcome, cache_path in cache_events:
+        print(f"Cache report: {artifact} {outcome} ({cache_path})")
+
+
+
+###############################################################################
+
+# Function for command-line arguments and input checks:
+
+# Exit codes per error class
+EXIT_USAGE = 2            # unknown flags, missing input file argument, non-integer cluster numbers, server port unavailable
+EXIT_INPUT_MISSING = 3    # input file (or tiles/assets directory, or a library copy of an offline map) does not exist or is not readable
+EXIT_INPUT_FORMAT = 4     # unsupported input file format
+EXIT_CLUSTER_RANGE = 5    # cluster number outside 5-500
+EXIT_OUTPUT = 6           # output file or cache directory not writable
+EXIT_INPUT_DATA = 7       # input file lacks a used column
+
+
+# Map libraries the map page loads from the network (folium 0.20 with the GroupedLayerControl and TagFilterButton
+# plugins), checked before anything is loaded for offline maps (the saved page is checked again, see missing_assets)
+MAP_LIBRARY_URLS = (
+    "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js",
+    "https://code.jquery.com/jquery-3.7.1.min.js",
+    "https://cdn.jsdelivr.net/npm/bootstrap@5.2.2/dist/js/bootstrap.bundle.min.js",
+    "https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.js",
+    "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css",
+    "https://cdn.jsdelivr.net/npm/bootstrap@5.2.2/dist/css/bootstrap.min.css",
+    "https://netdna.bootstrapcdn.com/bootstrap/3.0.0/css/bootstrap-glyphicons.css",
+    "https://cdn.jsdelivr.net/npm/@fortawesome/fontawesome-free@6.2.0/css/all.min.css",
+    "https://cdnjs.cloudflare.com/ajax/libs/Leaflet.awesome-markers/2.0.2/leaflet.awesome-markers.css",
+    "https://cdn.jsdelivr.net/gh/python-visualization/folium/folium/templates/leaflet.awesome.rotate.min.css",
+    "https://cdnjs.cloudflare.com/ajax/libs/leaflet-groupedlayercontrol/0.6.1/leaflet.groupedlayercontrol.min.js",
+    "https://cdnjs.cloudflare.com/ajax/libs/leaflet-groupedlayercontrol/0.6.1/leaflet.groupedlayercontrol.min.css",
+    "https://cdn.jsdelivr.net/npm/leaflet-tag-filter-button/src/leaflet-tag-filter-button.js",
+    "https://cdn.jsdelivr.net/npm/leaflet-easybutton@2/src/easy-button.js",
+    "https://cdn.jsdelivr.net/npm/leaflet-tag-filter-button/src/leaflet-tag-filter-button.css",
+    "https://cdn.jsdelivr.net/npm/leaflet-easybutton@2/src/easy-button.css",
+    "https://cdn.jsdelivr.net/npm/css-ripple-effect@1.0.5/dist/ripple.min.css",
+    )
+
+
+# Commands besides the map (first command-line argument) and their description
+COMMANDS = {
+    'benchmark': "Compare the clustering engines (run time and inertia) and the run time of the sunburst renderers (plotly express and graph_objects) on the popups of all clusters",
+    'sweep': "Cluster Y and mt with each of a list or range of cluster numbers (in parallel) and print the inertia and silhouette score per cluster number, optionally writing one map per cluster number",
+    'serve': "Serve the map from a local web server that loads the input file once and re-clusters on request (cluster numbers and mean BP range set in the map)"
+    }
+
+
+def terminate(message, exit_code):
+    '''
+
+    Prints an error message and exits with the given exit code.
+
+    '''
+
+    print(f"Error: {message}\nProgram terminated.")
+    sys.exit(exit_code)
+
+
+def writable_path(path):
+    '''
+
+    Parameters
+    ----------
+    path : str
+        File or directory that will be written (it may not exist yet).
+
+    Returns
+    -------
+    writable : bool
+        True if the path, or its closest existing parent directory, is writable.
+
+    '''
+
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+
+    return os.access(path, os.W_OK)
+
+
+def cluster_number(value):
+    '''
+
+    Returns
+    -------
+    n_clusters : int or str
+        The cluster number argument value as int, or 'auto' (argparse type of --cluster_Y and --cluster_mt).
+
+    '''
+
+    return 'auto' if value == 'auto' else int(value)
+
+
+def parse_arguments(argv):
+    '''
+
+    Parameters
+    ----------
+    argv : list
+        Command-line arguments (without the program name), optionally starting with a command (see COMMANDS).
+
+    Returns
+    -------
+    args : argparse.Namespace
+        The checked arguments (the command in args.command). Invalid arguments terminate the program with one of the EXIT_ codes.
+
+    '''
+
+    # Command (the map by default)
+    command = 'map'
+    if argv and argv[0] in COMMANDS:
+        command, argv = argv[0], argv[1:]
+
+    # Set up argument parser
+    if command == 'map':
+        parser = argparse.ArgumentParser(description="Specify cluster numbers for Y and mt",
+                                         epilog=f"Other commands: {', '.join(COMMANDS)} (see <command> --help)")
+    else:
+        parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} {command}", description=COMMANDS[command])
+
+    # Add input file as a positional argument
+    parser.add_argument('input_file', type=str, help='AADR annotations file, e.g. "AADR Annotations 2025.xlsx" (.xlsx, .xls, .anno, .tsv or .csv)')
+
+    # Define cluster arguments with optional flags
+    parser.add_argument('--cluster_Y', type=cluster_number, default=150, help="Cluster number for Y, or 'auto' (chosen at the elbow of the inertia curve) (default: 150)")
+    parser.add_argument('--cluster_mt', type=cluster_number, default=350, help="Cluster number for mt, or 'auto' (chosen at the elbow of the inertia curve) (default: 350)")
+    parser.add_argument('--auto_budget', type=float, default=DEFAULT_AUTO_BUDGET, help=f'Time budget in seconds per layer for choosing an auto cluster number (default: {DEFAULT_AUTO_BUDGET:g})')
+    parser.add_argument('--unweighted', action='store_true', help='Cluster the locations without weighting them by their number of individuals (every location counts once, as in earlier versions)')
+    parser.add_argument('--geometry', choices=CLUSTER_GEOMETRIES, default='planar', help="Clustering geometry: 'planar' (latitude and longitude as plane coordinates) or 'sphere' (points on the earth's surface, correct at high latitudes and across the antimeridian) (default: planar)")
+    parser.add_argument('--cluster_engine', '--cluster-engine', dest='cluster_engine', choices=CLUSTER_ENGINES, default='kmeans', help="Clustering engine: 'kmeans' (best of 10 K-Means fits), 'single_init' (one K-Means fit, about 10x faster) or 'minibatch' (MiniBatchKMeans, fastest for many locations); the faster engines give a few %% higher inertia (default: kmeans)")
+    # Define output options
+    if command == 'map':
+        parser.add_argument('--output', type=str, default="map.html", help='Output map file (default: map.html)')
+        parser.add_argument('--cluster_table', type=str, default=None, help='Also export the cluster metadata tables to <prefix>_Y.csv and <prefix>_mt.csv and the haplogroup counts per cluster to <prefix>_Y_haplogroups.csv and <prefix>_mt_haplogroups.csv')
+        parser.add_argument('--popup_mode', choices=POPUP_MODES, default=None, help="'iframe': every popup is its own html document loading plotly.js, 'shared': plotly.js is loaded once and popups render into plain divs, 'lazy': as shared, but the charts are built in the browser from the haplogroup counts, 'sidecar': as lazy, but the markers and clusters are written to per-cluster files next to the map (<output>_data) and fetched when shown (default: iframe, lazy with --offline)")
+        parser.add_argument('--binning', choices=BINNINGS, default=None, help="Aggregate the samples in fixed grid cells instead of clusters (cluster numbers are not used): 'hex' (hexagons in latitude and longitude) or 'grid' (equal-area cells)")
+        parser.add_argument('--cell_size', type=float, default=DEFAULT_CELL_SIZE, help=f'Cell size of the binning in degrees (hexagon center distance, grid cell height) (default: {DEFAULT_CELL_SIZE:g})')
+        parser.add_argument('--zoom_levels', action='store_true', help=f'Show coarser clusters (merged from the clusters, about {ZOOM_LEVEL_FACTOR}x fewer per zoom step) when zoomed out (lazy popup mode)')
+        parser.add_argument('--offline', action='store_true', help='Inline plotly.js once in the map file instead of loading it from the plotly CDN and use the local copies of the map libraries in --assets_dir (the program terminates if any is missing), and print the map file size')
+        parser.add_argument('--tiles_dir', type=str, default=None, help='Directory of local map tiles ({z}/{x}/{y}.png) used instead of the Esri satellite tiles')
+        parser.add_argument('--assets_dir', type=str, default=None, help='Directory of local copies of the map libraries (leaflet.js etc., file names as listed when --offline lacks them) used instead of their network URLs')
+        parser.add_argument('--renderer', choices=SUNBURST_RENDERERS, default='go', help="Sunburst renderer: 'go' (plotly graph_objects, fast) or 'px' (plotly express) (default: go)")
+        parser.add_argument('--jobs', type=int, default=1, help='Number of processes rendering the sunburst popups (iframe and shared popup mode), 0 for one per CPU (default: 1)')
+    # Define sweep options
+    if command == 'sweep':
+        parser.add_argument('--k', type=str, default=DEFAULT_SWEEP_K, help=f'Cluster numbers of the sweep, comma-separated numbers and ranges first-last:step, e.g. "50,100,150" or "25-500:25" (default: {DEFAULT_SWEEP_K})')
+        parser.add_argument('--jobs', type=int, default=1, help='Number of processes fitting the clusterings, 0 for one per CPU (default: 1)')
+        parser.add_argument('--maps', type=str, default=None, help='Also write the map of each cluster number (for Y and mt, lazy popup mode) to <prefix>_k<k>.html')
+    # Define server options
+    if command == 'serve':
+        parser.add_argument('--host', type=str, default="127.0.0.1", help='Address of the map server (default: 127.0.0.1, only this computer)')
+        parser.add_argument('--port', type=int, default=8000, help='Port of the map server (default: 8000)')
+        parser.add_argument('--tiles_dir', type=str, default=None, help='Directory of local map tiles ({z}/{x}/{y}.png) served under /tiles/ instead of the Esri satellite tiles')
+        parser.add_argument('--assets_dir', type=str, default=None, help='Directory of local copies of the map libraries (leaflet.js etc., file names as listed at server start) served under /assets/ instead of their network URLs')
+    # Define cache options
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help=f'Directory for cached copies of the parsed input file and of the clusterings (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--refresh_cache', action='store_true', help='Re-parse the input file and re-cluster, overwriting its cached copy, cleaned tables and clusterings')
+    parser.add_argument('--cache_report', action='store_true', help='Print cache hits and misses of this run')
+    parser.add_argument('--sequential_layers', action='store_true', help='Cluster (and render the popups of) Y and mt one after the other instead of concurrently in two processes (always sequential with one CPU)')
+    parser.add_argument('--timings', action='store_true', help='Print the run time of the program stages (incl. startup)')
+
+    # Parse arguments (argparse prints the usage problem, e.g. no integer given after a flag)
+    try:
+        args = parser.parse_args(argv)
+        args.command = command
+    except SystemExit as parser_exit:
+        if parser_exit.code == 0:
+            raise
+        terminate("Please only provide the AADR annotations file and optionally requested cluster numbers (integers between 5 and 500, or auto) and output/cache options.", EXIT_USAGE)
+
+    # Check of input file
+    if not os.path.isfile(args.input_file) or not os.access(args.input_file, os.R_OK):
+        terminate(f'Input file "{args.input_file}" not found or not readable.', EXIT_INPUT_MISSING)
+    if detect_input_format(args.input_file) is None:
+        terminate('Please provide the AADR annotations file as excel (e.g. "AADR Annotations 2025.xlsx") or tab-separated .anno/.tsv or .csv file.', EXIT_INPUT_FORMAT)
+
+    # Check if cluster numbers are within restricted range
+    if args.cluster_Y != 'auto' and not (5 <= args.cluster_Y <= 500):
+        terminate("Cluster number for Y must be between 5 and 500.", EXIT_CLUSTER_RANGE)
+    if args.cluster_mt != 'auto' and not (5 <= args.cluster_mt <= 500):
+        terminate("Cluster number for mt must be between 5 and 500.", EXIT_CLUSTER_RANGE)
+
+    if command == 'sweep':
+        try:
+            args.k_values = parse_k_values(args.k)
+        except ValueError as error:
+            terminate(f"{error}.", EXIT_USAGE)
+        if not all(5 <= k <= 500 for k in args.k_values):
+            terminate("Sweep cluster numbers must be between 5 and 500.", EXIT_CLUSTER_RANGE)
+
+    if command == 'map' and not (0.1 <= args.cell_size <= 45):
+        terminate("Cell size must be between 0.1 and 45 degrees.", EXIT_USAGE)
+    if args.auto_budget <= 0:
+        terminate("Auto cluster number budget must be more than 0 seconds.", EXIT_USAGE)
+
+    if command in ('map', 'sweep') and args.jobs < 0:
+        terminate("Number of jobs must be 0 (one per CPU) or more.", EXIT_USAGE)
+    if command in ('map', 'sweep') and args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    if command == 'serve' and not (0 <= args.port <= 65535):
+        terminate("Port must be between 0 and 65535.", EXIT_USAGE)
+
+    # Popup mode (offline maps load plotly.js once in the map page, so not in popup iframes)
+    if command == 'map':
+        if args.popup_mode is None:
+            args.popup_mode = 'lazy' if args.offline or args.zoom_levels else 'iframe'
+        if args.zoom_levels and args.popup_mode != 'lazy':
+            terminate("Zoom levels need the lazy popup mode (the markers of each level are created in the browser).", EXIT_USAGE)
+        if args.offline and args.popup_mode == 'iframe':
+            terminate("Offline maps need the shared or lazy popup mode (plotly.js cannot be inlined once for iframe popups).", EXIT_USAGE)
+
+    # Check local map tiles (the server serves them under /tiles/)
+    if command in ('map', 'serve') and args.tiles_dir:
+        if not os.path.isdir(args.tiles_dir):
+            terminate(f'Tiles directory "{args.tiles_dir}" not found.', EXIT_INPUT_MISSING)
+        if tile_extension(args.tiles_dir) is None:
+            terminate(f'Tiles directory "{args.tiles_dir}" contains no {{z}}/{{x}}/{{y}}.png (or .jpg/.jpeg/.webp) tiles.', EXIT_INPUT_MISSING)
+    if command == 'map':
+        args.tiles_url = local_tiles_url(args.tiles_dir, args.output) if args.tiles_dir else None
+    if command in ('map', 'serve') and args.assets_dir and not os.path.isdir(args.assets_dir):
+        terminate(f'Assets directory "{args.assets_dir}" not found.', EXIT_INPUT_MISSING)
+
+    # Offline maps need a local copy of every map library
+    if command == 'map' and args.offline:
+        if not args.assets_dir:
+            terminate("Offline maps need --assets_dir, a directory of local copies of the map libraries (see README.txt).", EXIT_USAGE)
+        missing = [url for url in MAP_LIBRARY_URLS if not os.path.isfile(os.path.join(args.assets_dir, os.path.basename(url)))]
+        if missing:
+            terminate(f"Offline maps need local copies of the map libraries; place these {len(missing)} files in the --assets_dir directory: "
+                      + ", ".join(missing), EXIT_INPUT_MISSING)
+
+    # Check output file (its directory must exist) and cache directory (created if needed)
+    if command == 'map':
+        output_dir = os.path.dirname(os.path.abspath(args.output))
+        if os.path.isdir(args.output) or not os.path.isdir(output_dir) or not writable_path(args.output):
+            terminate(f'Output file "{args.output}" is not writable.', EXIT_OUTPUT)
+    if command == 'map' and args.popup_mode == 'sidecar' and not writable_path(sidecar_dir(args.output)):
+        terminate(f'Sidecar directory "{sidecar_dir(args.output)}" is not writable.', EXIT_OUTPUT)
+    if command == 'map' and args.cluster_table and not all(writable_path(f"{args.cluster_table}_{table}.csv") for table in ("Y", "mt", "Y_haplogroups", "mt_haplogroups")):
+        terminate(f'Cluster table "{args.cluster_table}_Y.csv"/"_mt.csv" is not writable.', EXIT_OUTPUT)
+    if command == 'sweep' and args.maps and not all(writable_path(f"{args.maps}_k{k}.html") for k in args.k_values):
+        terminate(f'Sweep maps "{args.maps}_k<k>.html" are not writable.', EXIT_OUTPUT)
+    if not writable_path(args.cache_dir):
+        terminate(f'Cache directory "{args.cache_dir}" is not writable.', EXIT_OUTPUT)
+
+    return args
+
+
+
+###############################################################################
+
+# Functions for clustering and markers:
+
+# Clustering geometries: 'planar' (latitude and longitude as plane coordinates, as in earlier versions),
+# 'sphere' (3D unit vectors, see cluster_locations)
+CLUSTER_GEOMETRIES = ('planar', 'sphere')
+
+# Clustering engines: 'kmeans' fits K-Means 10 times (k-means++ starts) and keeps the best fit (lowest inertia),
+# 'single_init' fits it once (about 10x faster, inertia a few % higher),
+# 'minibatch' fits MiniBatchKMeans on batches of 1024 locations (3 starts, inertia a few % higher,
+# the fastest engine for many more locations than the batch size)
+CLUSTER_ENGINES = ('kmeans', 'single_init', 'minibatch')
+
+# Seed of the cluster initialization (reproducible clusters, part of the cluster cache key)
+CLUSTER_RANDOM_STATE = 42
+
+# Grid binnings instead of clustering (see bin_locations): 'hex' (hexagons in latitude and longitude),
+# 'grid' (equal-area cells); default cell size in degrees
+BINNINGS = ('hex', 'grid')
+DEFAULT_CELL_SIZE = 3.0
+
+# Zoom levels (see cluster_hierarchy): each coarser level has about ZOOM_LEVEL_FACTOR times fewer clusters (zooming
+# out by one halves the distances, so about as many markers are in view), down to ZOOM_LEVEL_MIN_CLUSTERS clusters;
+# the coarsest level is shown from the minimum zoom of the map (see create_map), each finer one from one zoom more
+ZOOM_LEVEL_FACTOR = 4
+ZOOM_LEVEL_MIN_CLUSTERS = 20
+ZOOM_LEVEL_FIRST_ZOOM = 2
+
+
+def cluster_estimator(n_clusters, engine='kmeans'):
+    '''
+
+    Returns
+    -------
+    kmeans : sklearn KMeans or MiniBatchKMeans object
+        Unfitted clustering model of the engine (see CLUSTER_ENGINES) with n_clusters clusters.
+
+    '''
+
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    # No random reassignment of small clusters (with many clusters per location it raises the inertia several-fold)
+    if engine == 'minibatch':
+        return MiniBatchKMeans(n_clusters=n_clusters, random_state=CLUSTER_RANDOM_STATE, n_init=3, batch_size=1024, reassignment_ratio=0.0)
+    if engine == 'single_init':
+        return KMeans(n_clusters=n_clusters, random_state=CLUSTER_RANDOM_STATE, n_init=1)
+
+    return KMeans(n_clusters=n_clusters, random_state=CLUSTER_RANDOM_STATE, n_init=10)
+
+
+def sphere_coordinates(lat_long):
+    '''
+
+    Returns
+    -------
+    xyz : numpy array
+        Unit vectors (x, y, z) of the locations (lat_long: array of latitudes and longitudes in degrees).
+
+    '''
+
+    import numpy as np
+
+    lat, long = np.radians(lat_long[:, 0]), np.radians(lat_long[:, 1])
+
+    return np.column_stack([np.cos(lat) * np.cos(long), np.cos(lat) * np.sin(long), np.sin(lat)])
+
+
+def lat_long_coordinates(xyz):
+    '''
+
+    Returns
+    -------
+    lat_long : numpy array
+        Latitudes and longitudes in degrees of the directions of the vectors xyz (e.g. cluster centers
+        inside the unit sphere, projected onto it).
+
+    '''
+
+    import numpy as np
+
+    lat = np.degrees(np.arctan2(xyz[:, 2], np.hypot(xyz[:, 0], xyz[:, 1])))
+    long = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0]))
+
+    return np.column_stack([lat, long])
+
+
+def cluster_cache_path(cache_dir, coords, weights, n_clusters, engine, geometry):
+    '''
+
+    Returns
+    -------
+    cache_path : str
+        Path of the cached clustering (.npz) of the locations coords (with weights) into n_clusters clusters, keyed
+        on the coordinates, weights, k, engine, geometry, random state, clustering code and scikit-learn version.
+
+    '''
+
+    from importlib.metadata import version
+
+    sha = hashlib.sha256()
+    sha.update(coords.tobytes())
+    sha.update(b'' if weights is None else weights.tobytes())
+    sha.update(repr((n_clusters, engine, geometry, CLUSTER_RANDOM_STATE, version('scikit-learn'))).encode('utf-8'))
+    sha.update(inspect.getsource(cluster_estimator).encode('utf-8'))
+
+    return os.path.join(cache_dir, f"clusters_{sha.hexdigest()[:20]}_v{CACHE_SCHEMA_VERSION}.npz")
+
+
+def cluster_locations(annotations, n_clusters, engine='kmeans', weighted=True, geometry='planar', cache_dir=None, refresh=False):
+    '''
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    n_clusters : int
+        Number of clusters (k).
+    engine : str
+        Clustering engine, see CLUSTER_ENGINES.
+    weighted : bool
+        Weight each location by its number of individuals (otherwise every location counts once).
+    geometry : str
+        'planar' clusters latitude and longitude as plane coordinates (in degrees), 'sphere' clusters the locations
+        as points on the unit sphere (3D unit vectors, distances along the earth's surface, also across the
+        antimeridian), see CLUSTER_GEOMETRIES.
+    cache_dir : str
+        Directory holding the cached clusterings (labels, centers and inertia), not cached if None.
+    refresh : bool
+        Re-cluster and overwrite the cached clustering.
+
+    Returns
+    -------
+    lat_long_locations : pandas dataframe
+        All coordinate combinations with their cluster label.
+    centers : numpy array
+        Latitude and longitude of the cluster centers (row = cluster label).
+    inertia : float
+        Sum of the squared distances of the locations (weighted) to their cluster center, in degrees ('planar')
+        or unit sphere radii ('sphere').
+
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    # Table of all coordinate combinations
+    lat_long_locations = annotations[["Lat", "Long"]].drop_duplicates()
+
+    # Convert lat_long to numpy arrays
+    coords = np.array(lat_long_locations[["Lat", "Long"]])
+
+    # Number of individuals per location (in the order of the locations)
+    weights = None
+    if weighted:
+        location_counts = annotations.value_counts(["Lat", "Long"], sort=False)
+        weights = location_counts.reindex(pd.MultiIndex.from_frame(lat_long_locations)).to_numpy()
+
+    # Cache hit: labels and centers of an earlier run on the same locations
+    cache_path = cache_dir and cluster_cache_path(cache_dir, coords, weights, n_clusters, engine, geometry)
+    if cache_path and os.path.isfile(cache_path) and not refresh:
+        cache_events.append((f"clusters (k={n_clusters})", 'hit', cache_path))
+        with np.load(cache_path) as cached:
+            lat_long_locations["Cluster"] = cached["labels"]
+            return lat_long_locations, cached["centers"], float(cached["inertia"])
+
+    # Fit KMeans (on the unit sphere: on the 3D unit vectors, centers projected back to latitude and longitude)
+    if geometry == 'sphere':
+        kmeans = cluster_estimator(n_clusters, engine).fit(sphere_coordinates(coords), sample_weight=weights)
+        centers = lat_long_coordinates(kmeans.cluster_centers_)
+    else:
+        kmeans = cluster_estimator(n_clusters, engine).fit(coords, sample_weight=weights)
+        centers = kmeans.cluster_centers_
+
+    # Add cluster labels
+    lat_long_locations["Cluster"] = kmeans.labels_
+
+    # Cache miss: store the clustering (written to a temporary file first, see load_cleaned_tables)
+    if cache_path:
+        cache_events.append((f"clusters (k={n_clusters})", 'miss', cache_path))
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as handle:
+            np.savez(handle, labels=kmeans.labels_.astype(np.int32), centers=centers, inertia=kmeans.inertia_)
+        os.replace(temp_path, cache_path)
+
+    return lat_long_locations, centers, kmeans.inertia_
+
+
+def bin_locations(annotations, binning='hex', cell_size=DEFAULT_CELL_SIZE):
+    '''
+
+    Assigns the sample locations to fixed grid cells (instead of clustering them), in one pass over the locations.
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    binning : str
+        'hex': hexagons in latitude and longitude, cell_size apart (center to center),
+        'grid': equal-area cells in rows of cell_size degrees latitude, each row divided into cells about cell_size
+        degrees wide at its center latitude (fewer cells towards the poles), see BINNINGS.
+    cell_size : float
+        Cell size in degrees.
+
+    Returns
+    -------
+    lat_long_locations : pandas dataframe
+        All coordinate combinations with their cell as cluster label (cells with samples numbered in grid order).
+    centers : numpy array
+        Latitude and longitude of the cell centers (row = cluster label).
+
+    '''
+
+    import numpy as np
+
+    # Table of all coordinate combinations
+    lat_long_locations = annotations[["Lat", "Long"]].drop_duplicates()
+    lat, long = lat_long_locations["Lat"].to_numpy(), lat_long_locations["Long"].to_numpy()
+
+    if binning == 'hex':
+        # Axial hexagon coordinates (pointy top, corners cell_size / sqrt(3) from the center), rounded via cube coordinates
+        radius = cell_size / np.sqrt(3)
+        q = (np.sqrt(3) / 3 * long - lat / 3) / radius
+        r = 2 / 3 * lat / radius
+        rounded_q, rounded_r, rounded_s = np.round(q), np.round(r), np.round(-q - r)
+        q_error, r_error, s_error = np.abs(rounded_q - q), np.abs(rounded_r - r), np.abs(rounded_s + q + r)
+        fix_q = (q_error > r_error) & (q_error > s_error)
+        fix_r = ~fix_q & (r_error > s_error)
+        rounded_q = np.where(fix_q, -rounded_r - rounded_s, rounded_q)
+        rounded_r = np.where(fix_r, -rounded_q - rounded_s, rounded_r)
+        cells = np.column_stack([rounded_r, rounded_q]).astype(np.int64)
+        cells, labels = np.unique(cells, axis=0, return_inverse=True)
+        centers = np.column_stack([1.5 * radius * cells[:, 0], np.sqrt(3) * radius * (cells[:, 1] + cells[:, 0] / 2)])
+    else:
+        # Row by latitude, column by longitude within the row (columns per row shrink with the cosine of the latitude)
+        rows = np.floor((lat + 90) / cell_size).astype(np.int64)
+        row_lat = -90 + (rows + 0.5) * cell_size
+        columns_per_row = np.maximum(1, np.round(360 * np.cos(np.radians(row_lat)) / cell_size)).astype(np.int64)
+        columns = np.minimum(np.floor((long + 180) / 360 * columns_per_row).astype(np.int64), columns_per_row - 1)
+        cells, labels = np.unique(np.column_stack([rows, columns, columns_per_row]), axis=0, return_inverse=True)
+        centers = np.column_stack([-90 + (cells[:, 0] + 0.5) * cell_size, -180 + (cells[:, 1] + 0.5) * 360 / cells[:, 2]])
+
+    # Add cell labels
+    lat_long_locations["Cluster"] = labels.ravel()
+
+    return lat_long_locations, centers
+
+
+def label_samples(annotations, lat_long_locations):
+    '''
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    lat_long_locations : pandas dataframe
+        All coordinate combinations with their cluster label, as returned by cluster_locations.
+
+    Returns
+    -------
+    annotations : pandas dataframe
+        The samples (in their original order) with the cluster label of their location in a "Cluster" column.
+
+    '''
+
+    # Join on the (already rounded) coordinates, once for all clusters
+    return annotations.merge(lat_long_locations, on=["Lat", "Long"], how="left", validate="many_to_one")
+
+
+def cluster_metadata(samples, centers):
+    '''
+
+    Parameters
+    ----------
+    samples : pandas dataframe
+        Cleaned Y or mt samples with cluster labels, as returned by label_samples.
+    centers : numpy array
+        Latitude and longitude of the cluster centers, as returned by cluster_locations.
+
+    Returns
+    -------
+    metadata : pandas dataframe
+        One row per cluster with samples (index "Cluster", ascending): cluster center ("Lat", "Long"), number of individuals,
+        earliest and latest BP range, sorted list of BP ranges and list of countries (in order of appearance).
+
+    '''
+
+    import pandas as pd
+
+    # Cluster center and number of individuals (clusters without samples, possible with MiniBatchKMeans, are left out)
+    metadata = pd.DataFrame(centers, columns=["Lat", "Long"]).rename_axis("Cluster")
+    individuals = samples.groupby("Cluster").size()
+    metadata = metadata.loc[individuals.index]
+    metadata["Individuals"] = individuals
+
+    # Unique BP ranges per cluster, sorted by age (order of the BP range categories)
+    bp_ranges = samples[["Cluster", "BP range"]].drop_duplicates().sort_values(["Cluster", "BP range"])
+    metadata["BP ranges"] = bp_ranges.groupby("Cluster")["BP range"].agg(lambda x: [str(bp_range) for bp_range in x])
+    metadata["Min BP range"] = metadata["BP ranges"].str[0]
+    metadata["Max BP range"] = metadata["BP ranges"].str[-1]
+
+    # Unique countries per cluster, in order of appearance
+    countries = samples[["Cluster", "Country"]].drop_duplicates()
+    metadata["Countries"] = countries.groupby("Cluster")["Country"].agg(list)
+
+    return metadata
+
+
+def cluster_bp_range(cluster):
+    '''
+
+    Parameters
+    ----------
+    cluster : pandas series
+        Row of the cluster metadata table (see cluster_metadata).
+
+    Returns
+    -------
+    cluster_range : str
+        BP range from the earliest to the latest BP range of the cluster (e.g. "5000-3000 BP").
+
+    '''
+
+    cluster_first_bp = cluster["Min BP range"].split("-")[0]
+    cluster_last_bp = cluster["Max BP range"].split("-")[1]
+    if cluster_first_bp == cluster_last_bp:
+        return f'{cluster["Min BP range"]} BP'
+
+    return f'{cluster_first_bp}-{cluster_last_bp} BP'
+
+
+def popup_legend(cluster):
+    '''
+
+    Parameters
+    ----------
+    cluster : pandas series
+        Row of the cluster metadata table (see cluster_metadata).
+
+    Returns
+    -------
+    popup_text : str
+        Legend of the cluster's sunburst chart: countries, number of individuals and BP range.
+
+    '''
+
+    # BP range from the earliest to the latest BP range of the cluster
+    cluster_range = cluster_bp_range(cluster)
+
+    # Countries
+    countries = cluster["Countries"]
+    if len(countries) < 2:
+        cluster_countries = countries[0]
+    else:
+        cluster_countries = f'{"<br>".join(countries)}'
+
+    return f'{cluster_countries}<br>{cluster["Individuals"]} individuals<br>{cluster_range}'
+
+
+def export_cluster_table(metadata, file_path):
+    '''
+
+    Writes the cluster metadata table (see cluster_metadata) to a csv file, with lists joined by "; ".
+
+    '''
+
+    table = metadata.copy()
+    table["BP ranges"] = table["BP ranges"].str.join("; ")
+    table["Countries"] = table["Countries"].str.join("; ")
+    table.to_csv(file_path)
+
+
+def cluster_layer(annotations, n_clusters, binning=None, cell_size=DEFAULT_CELL_SIZE, **cluster_options):
+    '''
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    n_clusters : int
+        Number of clusters (k), not used with a binning.
+    binning, cell_size
+        Grid cells instead of clusters (see bin_locations), the clusters if binning is None.
+    cluster_options
+        Clustering engine, weighting and geometry, see cluster_locations.
+
+    Returns
+    -------
+    metadata : pandas dataframe
+        Cluster metadata table, as returned by cluster_metadata.
+    counts, nodes
+        Haplogroup counts per cluster, as returned by haplogroup_count_matrix.
+
+    '''
+
+    if binning:
+        lat_long_locations, centers = bin_locations(annotations, binning, cell_size)
+        n_clusters = len(centers)
+    else:
+        lat_long_locations, centers, inertia = cluster_locations(annotations, n_clusters, **cluster_options)
+    samples = label_samples(annotations, lat_long_locations)
+    counts, nodes = haplogroup_count_matrix(samples, n_clusters)
+
+    return cluster_metadata(samples, centers), counts, nodes
+
+
+def rollup_clusters(metadata, counts, parents, geometry='planar'):
+    '''
+
+    Merges clusters into their parent clusters (one level up the cluster hierarchy, see cluster_hierarchy).
+
+    Parameters
+    ----------
+    metadata : pandas dataframe
+        Cluster metadata table, as returned by cluster_metadata.
+    counts : scipy.sparse csr_matrix
+        Haplogroup counts per cluster (row = cluster id), as returned by haplogroup_count_matrix.
+    parents : numpy array
+        Parent cluster (0 to number of parents - 1) of each cluster, in metadata order.
+    geometry : str
+        Clustering geometry, see cluster_locations (parent centers are averaged on the unit sphere for 'sphere').
+
+    Returns
+    -------
+    metadata, counts
+        Metadata table and haplogroup counts of the parent clusters: centers weighted by the individuals of the
+        clusters, individuals and counts summed, BP ranges and countries merged.
+
+    '''
+
+    import numpy as np
+    from scipy import sparse
+
+    # Counts summed over the clusters of each parent
+    n_parents = int(parents.max()) + 1
+    assignment = sparse.csr_matrix((np.ones(len(parents), dtype=np.int64), (parents, metadata.index.to_numpy())),
+                                   shape=(n_parents, counts.shape[0]))
+    parent_counts = (assignment @ counts).tocsr()
+    parent_counts.sort_indices()
+
+    # Centers weighted by individuals (on the unit sphere the direction of the weighted sum of the unit vectors)
+    weights = metadata["Individuals"].to_numpy(dtype=float)
+    coords = metadata[["Lat", "Long"]].to_numpy()
+    if geometry == 'sphere':
+        coords = sphere_coordinates(coords)
+    centers = np.zeros((n_parents, coords.shape[1]))
+    np.add.at(centers, parents, coords * weights[:, None])
+    if geometry == 'sphere':
+        centers = lat_long_coordinates(centers)
+    else:
+        centers /= np.bincount(parents, weights=weights, minlength=n_parents)[:, None]
+
+    # Individuals summed, BP ranges (sorted by age) and countries (in order of appearance) merged
+    grouped = metadata.assign(Parent=parents).groupby("Parent", sort=True)
+    parent_metadata = grouped[["Individuals"]].sum().rename_axis("Cluster")
+    parent_metadata.insert(0, "Lat", centers[:, 0])
+    parent_metadata.insert(1, "Long", centers[:, 1])
+    parent_metadata["BP ranges"] = grouped["BP ranges"].agg(
+        lambda bp_ranges: sorted(set().union(*bp_ranges), key=lambda bp_range: int(bp_range.split('-')[0])))
+    parent_metadata["Min BP range"] = parent_metadata["BP ranges"].str[0]
+    parent_metadata["Max BP range"] = parent_metadata["BP ranges"].str[-1]
+    parent_metadata["Countries"] = grouped["Countries"].agg(
+        lambda countries: list(dict.fromkeys(country for cluster_countries in countries for country in cluster_countries)))
+
+    return parent_metadata, parent_counts
+
+
+def cluster_hierarchy(metadata, counts, geometry='planar'):
+    '''
+
+    Builds coarser cluster levels of a layer for zoomed-out map views: the cluster centers are merged by
+    agglomerative (Ward) clustering, and each level holds about ZOOM_LEVEL_FACTOR times fewer clusters than the next
+    finer one (at least ZOOM_LEVEL_MIN_CLUSTERS). The levels are nested; each is rolled up from the next finer level
+    (see rollup_clusters), not re-aggregated from the samples.
+
+    Parameters
+    ----------
+    metadata, counts
+        Cluster metadata table and haplogroup counts of the layer, as returned by cluster_layer.
+    geometry : str
+        Clustering geometry, see cluster_locations.
+
+    Returns
+    -------
+    levels : list
+        (metadata, counts) of each coarser level, from the coarsest to the next coarser than the given clusters
+        (empty if there are too few clusters).
+
+    '''
+
+    import numpy as np
+    from scipy.cluster.hierarchy import fcluster, linkage
+
+    # Number of clusters per level (finest first)
+    sizes = [len(metadata)]
+    while sizes[-1] // ZOOM_LEVEL_FACTOR >= ZOOM_LEVEL_MIN_CLUSTERS:
+        sizes.append(sizes[-1] // ZOOM_LEVEL_FACTOR)
+    if len(sizes) == 1:
+        return []
+
+    # One tree over the cluster centers, cut into each coarser level (cluster of every center per level)
+    coords = metadata[["Lat", "Long"]].to_numpy()
+    tree = linkage(sphere_coordinates(coords) if geometry == 'sphere' else coords, method='ward')
+    cuts = [np.arange(len(metadata))]
+    cuts += [np.unique(fcluster(tree, size, criterion='maxclust'), return_inverse=True)[1] for size in sizes[1:]]
+
+    # Roll each level up from the next finer one (parent = coarser cluster of any center of the cluster)
+    levels = [(metadata, counts)]
+    for finer, coarser in zip(cuts[:-1], cuts[1:]):
+        _, first_center = np.unique(finer, return_index=True)
+        levels.append(rollup_clusters(*levels[-1], coarser[first_center], geometry))
+
+    return levels[:0:-1]
+
+
+def popup_tasks(metadata, counts, nodes, popup_mode, renderer='go'):
+    '''
+
+    Returns
+    -------
+    tasks : list
+        Sunburst popups of a layer's clusters to render ('iframe' and 'shared' popup mode), see render_popup.
+
+    '''
+
+    return [(popup_mode, sunburst_arrays(counts, nodes, cluster_id), popup_legend(cluster), renderer)
+            for cluster_id, cluster in metadata.iterrows()]
+
+
+def layer_pipeline(annotations, n_clusters, popup_mode=None, renderer='go', jobs=1, cluster_options=None, threads=None):
+    '''
+
+    Clusters a layer (see cluster_layer) and renders its sunburst popups (see render_popups).
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    n_clusters : int
+        Number of clusters (k).
+    popup_mode : str
+        Popup mode (see POPUP_MODES), popups are only rendered for 'iframe' and 'shared' (not at all if None).
+    renderer, jobs
+        Sunburst renderer and number of rendering processes, see render_popups.
+    cluster_options : dict
+        Clustering engine, weighting and geometry, see cluster_locations.
+    threads : int
+        Limit of the threads used by the clustering (all CPUs if None).
+
+    Returns
+    -------
+    metadata, counts, nodes
+        As returned by cluster_layer.
+    rendered : list or None
+        Rendered popups in cluster order, see render_popups.
+
+    '''
+
+    from threadpoolctl import threadpool_limits
+
+    with threadpool_limits(limits=threads):
+        metadata, counts, nodes = cluster_layer(annotations, n_clusters, **(cluster_options or {}))
+
+    rendered = None
+    if popup_mode in ('iframe', 'shared'):
+        rendered = render_popups(popup_tasks(metadata, counts, nodes, popup_mode, renderer), jobs)
+
+    return metadata, counts, nodes, rendered
+
+
+def logged_layer_pipeline(*args, **kwargs):
+    '''
+
+    Returns
+    -------
+    result : tuple
+        As returned by layer_pipeline (called with args and kwargs, in a worker process).
+    events : list
+        Cache lookups of the call, see cache_events.
+
+    '''
+
+    start = len(cache_events)
+    result = layer_pipeline(*args, **kwargs)
+
+    return result, cache_events[start:]
+
+
+def run_layer_pipelines(layers, concurrent=True, **options):
+    '''
+
+    Runs the layer pipelines (see layer_pipeline), concurrently in one process per layer if concurrent.
+
+    Parameters
+    ----------
+    layers : dict
+        Layer name ('Y', 'mt') and its (annotations, n_clusters).
+    concurrent : bool
+        Run the layers in separate processes (each clustering with its share of the CPUs and rendering
+        with its share of the jobs).
+    options
+        popup_mode, renderer, jobs and cluster_options, see layer_pipeline.
+
+    Returns
+    -------
+    results : dict
+        Layer name and its (metadata, counts, nodes, rendered), as returned by layer_pipeline.
+
+    '''
+
+    if not concurrent:
+        return {layer: layer_pipeline(annotations, n_clusters, **options) for layer, (annotations, n_clusters) in layers.items()}
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Import sklearn before starting the workers (inherited by forked workers instead of imported by each)
+    import sklearn.cluster
+
+    threads = max(1, (os.cpu_count() or 1) // len(layers))
+    options['jobs'] = max(1, options.get('jobs', 1) // len(layers))
+    with ProcessPoolExecutor(max_workers=len(layers)) as executor:
+        futures = {layer: executor.submit(logged_layer_pipeline, annotations, n_clusters, threads=threads, **options)
+                   for layer, (annotations, n_clusters) in layers.items()}
+        results = {}
+        for layer, future in futures.items():
+            results[layer], events = future.result()
+            cache_events.extend(events)
+        return results
+
+
+def add_cluster_markers(feature_group, metadata, counts, nodes, renderer='go', popup_mode='iframe', layer='Y', jobs=1, rendered=None, levels=None):
+    '''
+
+    Adds one marker with a sunburst popup per cluster to the feature group (map layer).
+
+    Parameters
+    ----------
+    feature_group : folium.FeatureGroup object
+        Map layer of the markers (Y or mt).
+    metadata : pandas dataframe
+        Cluster metadata table, as returned by cluster_metadata.
+    counts, nodes
+        Haplogroup counts per cluster, as returned by haplogroup_count_matrix.
+    renderer : str
+        Sunburst renderer, see sunburst_figure.
+    popup_mode : str
+        'iframe', 'shared', 'lazy' or 'sidecar', see POPUP_MODES.
+    layer : str
+        Layer name ('Y' or 'mt').
+    jobs : int
+        Number of processes rendering the sunburst charts ('iframe' and 'shared'), see render_popups.
+    rendered : list
+        Sunburst charts already rendered in cluster order (see layer_pipeline), rendered here if None.
+    levels : list
+        Coarser cluster levels shown when zoomed out ('lazy'), as returned by cluster_hierarchy (one level if None).
+
+    Returns
+    -------
+    popup_data : dict
+        Popup data of the layer for add_page_popups: the sunburst charts by cluster id ('shared'),
+        the node table and cluster records ('lazy'), the cluster records for write_sidecar_files ('sidecar'),
+        empty in 'iframe' popup mode.
+
+    '''
+
+    import folium
+
+    # Render the sunburst charts ('iframe' and 'shared' popup mode, in cluster order)
+    if popup_mode in ('iframe', 'shared') and rendered is None:
+        rendered = render_popups(popup_tasks(metadata, counts, nodes, popup_mode, renderer), jobs)
+
+    # Loop through clusters
+    popup_data = {}
+    for position, (cluster_id, cluster) in enumerate(metadata.iterrows()):
+
+        # Lazy and sidecar popup mode: only store the cluster's counts and metadata (the markers are created in the browser)
+        if popup_mode == 'lazy':
+            popup_data[cluster_id] = lazy_cluster_record(cluster, counts, cluster_id)
+            continue
+        if popup_mode == 'sidecar':
+            popup_data[cluster_id] = sidecar_cluster_record(cluster, counts, nodes, cluster_id)
+            continue
+
+        # Create popup (the sunburst as iframe, or as chart data for the map page) and add marker
+        if popup_mode == 'iframe':
+            popup = iframe_popup(rendered[position])
+        else:
+            popup = create_sunburst_div(layer, cluster_id, popup_legend(cluster))
+            popup_data[cluster_id] = rendered[position]
+        folium.CircleMarker(
+            location=[cluster["Lat"], cluster["Long"]],
+            radius=5,
+            color="black",
+            fill=True,
+            fill_opacity=1,
+            fill_color="black",
+            popup=popup,
+            tags=cluster["BP ranges"]
+        ).add_to(feature_group)
+
+    if popup_mode == 'lazy':
+        popup_data = lazy_layer_data(nodes, popup_data)
+        if levels:
+            add_zoom_levels(popup_data, levels)
+    if popup_mode in ('lazy', 'sidecar'):
+        add_client_markers(feature_group, layer, popup_mode)
+
+    return popup_data
+
+
+# Map tile file in a tiles directory: {z}/{x}/{y}.<extension>
+TILE_PATTERN = re.compile(r"\d+/\d+/\d+\.(png|jpg|jpeg|webp)")
+
+
+def tile_extension(tiles_dir):
+    '''
+
+    Returns
+    -------
+    extension : str or None
+        File extension of the map tiles in tiles_dir ({z}/{x}/{y}.<png|jpg|jpeg|webp> layout), None if the directory
+        contains no tiles.
+
+    '''
+
+    for directory, _, files in os.walk(tiles_dir):
+        for file in files:
+            tile = os.path.relpath(os.path.join(directory, file), tiles_dir).replace(os.sep, "/")
+            match = TILE_PATTERN.fullmatch(tile)
+            if match:
+                return match.group(1)
+
+    return None
+
+
+def local_tiles_url(tiles_dir, output):
+    '''
+
+    Parameters
+    ----------
+    tiles_dir : str
+        Directory of map tiles in {z}/{x}/{y}.<png|jpg|jpeg|webp> layout.
+    output : str
+        Output map file (the tiles are referenced relative to it).
+
+    Returns
+    -------
+    tiles_url : str or None
+        URL template of the tiles for the map, None if the directory contains no tiles.
+
+    '''
+
+    extension = tile_extension(tiles_dir)
+    if extension is None:
+        return None
+    tiles_path = os.path.relpath(tiles_dir, os.path.dirname(os.path.abspath(output))).replace(os.sep, "/")
+
+    return f"{tiles_path}/{{z}}/{{x}}/{{y}}.{extension}"
+
+
+def network_files(html):
+    '''
+
+    Returns
+    -------
+    urls : list
+        URLs of the scripts and stylesheets the map page loads from the network.
+
+    '''
+
+    return re.findall(r'<(?:script|link)\b[^>]*?(?:src|href)="(https?://[^"]+)"', html)
+
+
+def missing_assets(html, assets_dir):
+    '''
+
+    Returns
+    -------
+    urls : list
+        URLs of the scripts and stylesheets of the map page (see network_files) without a local copy (same file name)
+        in assets_dir (all of them if assets_dir is None).
+
+    '''
+
+    return [url for url in network_files(html)
+            if not (assets_dir and os.path.isfile(os.path.join(assets_dir, os.path.basename(url))))]
+
+
+def localize_html(html, assets_dir, assets_url):
+    '''
+
+    Returns
+    -------
+    html : str
+        The map page html with the scripts and stylesheets that have a local copy (same file name) in assets_dir
+        pointed at <assets_url>/<file name> instead of their network URL.
+
+    '''
+
+    for url in network_files(html):
+        if os.path.isfile(os.path.join(assets_dir, os.path.basename(url))):
+            html = html.replace(f'"{url}"', f'"{assets_url}/{os.path.basename(url)}"')
+
+    return html
+
+
+def localize_assets(file_path, assets_dir):
+    '''
+
+    Points the scripts and stylesheets of the saved map that have a local copy (same file name) in assets_dir
+    at that copy (relative to the map file) instead of their network URL.
+
+    '''
+
+    with open(file_path, encoding="utf-8") as file:
+        html = file.read()
+    assets_url = os.path.relpath(assets_dir, os.path.dirname(os.path.abspath(file_path))).replace(os.sep, "/")
+    with open(file_path, "w", encoding="utf-8") as file:
+        file.write(localize_html(html, assets_dir, assets_url))
+
+
+def report_bundle_size(file_path):
+    '''
+
+    Prints the size of the saved map file and the share of the inlined plotly.js bundle (offline mode).
+
+    '''
+
+    from plotly.offline import get_plotlyjs
+
+    plotly_size = len(get_plotlyjs().encode("utf-8"))
+
+    print(f"Map file: {file_path}, {os.path.getsize(file_path) / 1e6:.2f} MB (plotly.js {plotly_size / 1e6:.2f} MB, inlined once)")
+
+
+def create_map(tiles_url=None):
+    '''
+
+    Parameters
+    ----------
+    tiles_url : str
+        URL template of local map tiles (see local_tiles_url), the Esri satellite tiles if None.
+
+    Returns
+    -------
+    m : folium.Map object
+        The map with its starting conditions and layer buttons.
+    fg_Y, fg_mt : folium.FeatureGroup objects
+        The (empty) Y and mt marker layers.
+
+    '''
+
+    import folium
+    from folium.plugins import GroupedLayerControl
+
+    # Initialize map and set starting conditions
+    m = folium.Map(location=[30,20],
+                   tiles=tiles_url or "Esri.WorldImagery",
+                   attr="Local tiles" if tiles_url else None,
+                   zoom_start=2.5,
+                   min_zoom=2,
+                   max_zoom=7,
+                   max_bounds=True)
+
+    # Set group layers to separate Y and mt markers with interactive map buttons
+    fg_Y = folium.FeatureGroup(name='Y')
+    fg_mt = folium.FeatureGroup(name='mtDNA')
+    m.add_child(fg_Y)
+    m.add_child(fg_mt)
+    GroupedLayerControl(
+        groups={'Haplogroups': [fg_Y, fg_mt]},
+        collapsed=False,
+    ).add_to(m)
+
+    return m, fg_Y, fg_mt
+
+
+def add_bp_range_filter(m, bp_range_categories):
+    '''
+
+    Adds BP range tag-filter buttons to the map (after the markers).
+
+    Parameters
+    ----------
+    m : folium.Map object
+        The map.
+    bp_range_categories : list
+        BP range categories present in the data.
+
+    '''
+
+    from folium.plugins import TagFilterButton
+
+    # Sort BP range categories
+    bp_range_categories_sorted = sorted(bp_range_categories, key=lambda x: int(x.split('-')[0]))
+    # BP range tag-filter buttons
+    TagFilterButton(bp_range_categories_sorted).add_to(m)
+
+
+
+###############################################################################
+
+# Functions for the clustering engine and renderer benchmarks:
+
+def benchmark_engines(layers, weighted=True, geometry='planar'):
+    '''
+
+    Clusters the locations of each layer with each clustering engine and prints the fit times and inertias
+    (sum of squared distances of the locations to their cluster center, lower is better) compared to 'kmeans'.
+
+    Parameters
+    ----------
+    layers : dict
+        Layer name ('Y', 'mt') and its (annotations, n_clusters).
+    weighted, geometry
+        Weighting and geometry of the clustering, see cluster_locations.
+
+    '''
+
+    # Library imports untimed
+    import sklearn.cluster
+
+    results = {}
+    for engine in CLUSTER_ENGINES:
+        for layer, (annotations, n_clusters) in layers.items():
+            start = time.perf_counter()
+            lat_long_locations, centers, inertia = cluster_locations(annotations, n_clusters, engine, weighted, geometry)
+            results[engine, layer] = (time.perf_counter() - start, inertia, len(lat_long_locations))
+
+    print(f"{'Engine':<13}{'Layer':<8}{'k':>6}{'Locations':>11}{'Fit (s)':>10}{'Speed-up':>10}{'Inertia':>14}{'vs kmeans':>11}")
+    for (engine, layer), (seconds, inertia, n_locations) in results.items():
+        default_seconds, default_inertia, _ = results['kmeans', layer]
+        print(f"{engine:<13}{layer:<8}{layers[layer][1]:>6}{n_locations:>11}{seconds:>10.3f}{default_seconds / seconds:>9.1f}x"
+              + f"{inertia:>14.1f}{100 * (inertia / default_inertia - 1):>+10.1f}%")
+    print()
+
+
+def benchmark_renderers(layers):
+    '''
+
+    Renders the popups of all clusters with each sunburst renderer and prints the run times.
+
+    Parameters
+    ----------
+    layers : dict
+        Layer name ('Y', 'mt') and its (metadata, counts, nodes), as returned by cluster_layer.
+
+    '''
+
+    results = {}
+    for renderer in SUNBURST_RENDERERS:
+        for layer, (metadata, counts, nodes) in layers.items():
+            popups = [(sunburst_arrays(counts, nodes, cluster_id), popup_legend(cluster)) for cluster_id, cluster in metadata.iterrows()]
+            # First popup untimed (library imports)
+            create_Sunburst(*popups[0], renderer)
+            start = time.perf_counter()
+            for sunburst_data, popup_text in popups:
+                create_Sunburst(sunburst_data, popup_text, renderer)
+            results[renderer, layer] = time.perf_counter() - start
+
+    print(f"{'Renderer':<10}{'Layer':<8}{'Popups':>8}{'Total (s)':>12}{'Per popup (ms)':>16}{'Speed-up':>10}")
+    for (renderer, layer), seconds in results.items():
+        n_popups = len(layers[layer][0])
+        speedup = results['px', layer] / seconds
+        print(f"{renderer:<10}{layer:<8}{n_popups:>8}{seconds:>12.3f}{1000 * seconds / n_popups:>16.2f}{speedup:>9.1f}x")
+
+
+
+###############################################################################
+
+# Functions for the cluster number sweep and automatic cluster numbers:
+
+# Default cluster numbers of the sweep (first-last:step, see parse_k_values)
+DEFAULT_SWEEP_K = "25-500:25"
+
+# Individuals (or locations, unweighted) per layer and k the silhouette score is computed on
+SWEEP_SILHOUETTE_SAMPLE = 2000
+
+# Candidate cluster numbers of --cluster_Y/--cluster_mt auto, default time budget (s) per layer and the fits made
+# even if the budget is spent (the first and last candidate and the middle, see coarse_to_fine)
+AUTO_K_VALUES = range(25, 501, 25)
+DEFAULT_AUTO_BUDGET = 10.0
+AUTO_MIN_FITS = 3
+
+
+def parse_k_values(spec):
+    '''
+
+    Parameters
+    ----------
+    spec : str
+        Comma-separated cluster numbers and ranges, e.g. "50,100,150" or "25-500:25" (first-last:step, step 1 if
+        omitted).
+
+    Returns
+    -------
+    k_values : list
+        The sorted, distinct cluster numbers.
+
+    Raises
+    ------
+    ValueError
+        If an item is not an integer or range, or a range is reversed.
+
+    '''
+
+    k_values = set()
+    for item in spec.split(','):
+        match = re.fullmatch(r'\s*(\d+)\s*(?:-\s*(\d+)\s*(?::\s*(\d+)\s*)?)?', item)
+        if match is None or match.group(3) == '0' or (match.group(3) and not match.group(2)):
+            raise ValueError(f'"{item.strip()}" is no cluster number or range (first-last:step)')
+        first, last, step = match.groups()
+        if last and int(last) < int(first):
+            raise ValueError(f'"{item.strip()}" is a reversed range (first-last:step needs first <= last)')
+        k_values.update(range(int(first), int(last or first) + 1, int(step or 1)))
+
+    return sorted(k_values)
+
+
+def sweep_fit(annotations, n_clusters, cluster_options, threads=None):
+    '''
+
+    Clusters a layer (see cluster_locations) and scores the clustering.
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    n_clusters : int
+        Number of clusters (k).
+    cluster_options : dict
+        Clustering engine, weighting, geometry and cache, see cluster_locations.
+    threads : int
+        Limit of the threads used by the clustering (all CPUs if None).
+
+    Returns
+    -------
+    seconds : float
+        Run time of the clustering (loading it from the cache on a cache hit).
+    inertia : float
+        Inertia of the clustering, see cluster_locations.
+    silhouette : float
+        Silhouette score (-1 to 1, higher means better separated clusters) of a sample of SWEEP_SILHOUETTE_SAMPLE
+        individuals (locations if unweighted), in the clustering geometry.
+    events : list
+        Cache lookups of the call, see cache_events.
+
+    '''
+
+    from sklearn.metrics import silhouette_score
+    from threadpoolctl import threadpool_limits
+
+    start_events = len(cache_events)
+    start = time.perf_counter()
+    with threadpool_limits(limits=threads):
+        lat_long_locations, centers, inertia = cluster_locations(annotations, n_clusters, **cluster_options)
+    seconds = time.perf_counter() - start
+
+    # Individuals weigh in as often as they were clustered (each location once if unweighted)
+    points = label_samples(annotations, lat_long_locations) if cluster_options.get('weighted', True) else lat_long_locations
+    coords = points[["Lat", "Long"]].to_numpy()
+    if cluster_options.get('geometry') == 'sphere':
+        coords = sphere_coordinates(coords)
+    silhouette = silhouette_score(coords, points["Cluster"], sample_size=min(SWEEP_SILHOUETTE_SAMPLE, len(points)),
+                                  random_state=CLUSTER_RANDOM_STATE)
+
+    return seconds, inertia, silhouette, cache_events[start_events:]
+
+
+def sweep_cluster_numbers(layers, k_values, jobs=1, cluster_options=None):
+    '''
+
+    Clusters each layer with each cluster number (in jobs processes) and prints the inertia and silhouette score per
+    layer and k (and the fit time, 'cached' for clusterings loaded from the cache).
+
+    Parameters
+    ----------
+    layers : dict
+        Layer name ('Y', 'mt') and its annotations.
+    k_values : list
+        Cluster numbers.
+    jobs : int
+        Number of processes fitting the clusterings (each with its share of the CPUs).
+    cluster_options : dict
+        Clustering engine, weighting, geometry and cache, see cluster_locations.
+
+    Returns
+    -------
+    results : dict
+        (layer, k) and its (seconds, inertia, silhouette), see sweep_fit.
+
+    '''
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Import sklearn before starting the workers (inherited by forked workers instead of imported by each)
+    import sklearn.cluster
+    import sklearn.metrics
+
+    # Largest fits first, so the last running fits are short
+    fits = sorted(((layer, k) for layer in layers for k in k_values), key=lambda fit: -fit[1] * len(layers[fit[0]]))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    if jobs == 1:
+        outcomes = {(layer, k): sweep_fit(layers[layer], k, cluster_options or {}) for layer, k in fits}
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {(layer, k): executor.submit(sweep_fit, layers[layer], k, cluster_options or {}, threads) for layer, k in fits}
+            outcomes = {fit: future.result() for fit, future in futures.items()}
+
+    results = {}
+    print(f"{'Layer':<8}{'k':>6}{'Locations':>11}{'Fit (s)':>10}{'Inertia':>14}{'Silhouette':>12}")
+    for layer in layers:
+        n_locations = len(layers[layer][["Lat", "Long"]].drop_duplicates())
+        for k in k_values:
+            seconds, inertia, silhouette, events = outcomes[layer, k]
+            if jobs > 1:
+                cache_events.extend(events)
+            results[layer, k] = (seconds, inertia, silhouette)
+            fit_time = "cached" if any(outcome == 'hit' for _, outcome, _ in events) else f"{seconds:.3f}"
+            print(f"{layer:<8}{k:>6}{n_locations:>11}{fit_time:>10}{inertia:>14.1f}{silhouette:>12.3f}")
+    print()
+
+    return results
+
+
+def coarse_to_fine(k_values):
+    '''
+
+    Returns
+    -------
+    k_values : list
+        The sorted cluster numbers k_values reordered so that every prefix spans their range: first and last, then
+        the middle, then the middles of the halves and so on.
+
+    '''
+
+    order = [k_values[0], k_values[-1]] if len(k_values) > 1 else list(k_values)
+    intervals = [(0, len(k_values) - 1)]
+    while intervals:
+        first, last = intervals.pop(0)
+        if last - first > 1:
+            middle = (first + last) // 2
+            order.append(k_values[middle])
+            intervals += [(first, middle), (middle, last)]
+
+    return order
+
+
+def elbow_k(k_values, inertias):
+    '''
+
+    Parameters
+    ----------
+    k_values : list
+        Sorted cluster numbers (at least 3).
+    inertias : list
+        Inertia of the clustering with each cluster number.
+
+    Returns
+    -------
+    k : int
+        Elbow of the inertia curve: the cluster number farthest below the line between the first and last point
+        (k and inertia scaled to 0-1).
+
+    '''
+
+    import numpy as np
+
+    k = np.asarray(k_values, dtype=float)
+    inertia = np.asarray(inertias, dtype=float)
+    k_scaled = (k - k[0]) / (k[-1] - k[0])
+    inertia_scaled = (inertia - inertia[-1]) / max(inertia[0] - inertia[-1], 1e-12)
+
+    return int(k_values[int(np.argmax(1 - inertia_scaled - k_scaled))])
+
+
+def auto_cluster_number(annotations, budget, cluster_options=None, layer='Y'):
+    '''
+
+    Chooses the cluster number of a layer at the elbow of its inertia curve (see elbow_k), fitting the cluster
+    numbers of AUTO_K_VALUES coarse to fine (see coarse_to_fine) with the 'single_init' engine until the time budget
+    is spent, and prints the choice.
+
+    Parameters
+    ----------
+    annotations : pandas dataframe
+        Cleaned Y or mt samples.
+    budget : float
+        Time budget of the search in seconds (at least AUTO_MIN_FITS fits are made).
+    cluster_options : dict
+        Weighting, geometry and cache of the clustering, see cluster_locations (the engine is ignored).
+    layer : str
+        Layer name ('Y', 'mt') for the printed choice.
+
+    Returns
+    -------
+    k : int
+        The chosen cluster number.
+
+    Raises
+    ------
+    ValueError
+        If the layer has fewer than 5 locations.
+
+    '''
+
+    options = dict(cluster_options or {}, engine='single_init')
+    n_locations = len(annotations[["Lat", "Long"]].drop_duplicates())
+    if n_locations < 5:
+        raise ValueError(f"{layer} samples have only {n_locations} locations, at least 5 are needed for a cluster number")
+    # With fewer locations than the smallest candidate one cluster per location
+    candidates = [k for k in AUTO_K_VALUES if k <= n_locations] or [n_locations]
+
+    # Fit until the budget is spent (the fits are cached, so a rerun fits the same cluster numbers instantly)
+    start = time.perf_counter()
+    inertias = {}
+    for k in coarse_to_fine(candidates):
+        if len(inertias) >= AUTO_MIN_FITS and time.perf_counter() - start > budget:
+            break
+        inertias[k] = cluster_locations(annotations, k, **options)[2]
+    seconds = time.perf_counter() - start
+
+    k_values = sorted(inertias)
+    k = elbow_k(k_values, [inertias[k] for k in k_values]) if len(k_values) >= 3 else k_values[-1]
+    print(f"Auto cluster number: {layer} k={k} (elbow of {len(k_values)} of {len(candidates)} cluster numbers "
+          f"{k_values[0]}-{k_values[-1]}, {seconds:.2f} s of {budget:g} s budget)")
+
+    return k
+
+
+def sweep_map(file_path, layers, bp_range_categories):
+    '''
+
+    Writes the map of one sweep cluster number (lazy popup mode).
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the map file.
+    layers : dict
+        Layer name ('Y', 'mt') and its (metadata, counts, nodes), as returned by cluster_layer.
+    bp_range_categories : list
+        BP range categories present in the data.
+
+    '''
+
+    m, fg_Y, fg_mt = create_map()
+    popup_data = {layer: add_cluster_markers(feature_group, *layers[layer], popup_mode='lazy', layer=layer)
+                  for layer, feature_group in (('Y', fg_Y), ('mt', fg_mt))}
+    add_page_popups(m, popup_data, 'lazy')
+    add_bp_range_filter(m, bp_range_categories)
+    m.save(file_path)
+
+
+
+###############################################################################
+
+# Functions for the map server:
+
+# Clustering results of the map server kept in memory (layer, k and BP range combinations)
+SERVER_CACHE_SIZE = 32
+
+# Cluster number and BP range controls of the map server page (reload the markers with the new query)
+SERVER_CONTROLS = string.Template("""<div id="hv-controls" style="position: fixed; bottom: 20px; left: 10px; z-index: 1000; padding: 6px; background: white; border-radius: 4px; font-family: Arial; font-size: 13px">
+Clusters Y <input id="hv-k-Y" type="number" min="5" max="500" value="$k_Y" style="width: 4em">
+mt <input id="hv-k-mt" type="number" min="5" max="500" value="$k_mt" style="width: 4em">
+Mean BP <input id="hv-min-bp" type="number" min="0" placeholder="from" style="width: 5em">
+- <input id="hv-max-bp" type="number" min="0" placeholder="to" style="width: 5em">
+<button id="hv-apply">Apply</button>
+</div>
+<script>
+var hvQuery = {Y: $k_Y, mt: $k_mt, min_bp: '', max_bp: ''};
+function hvLayerQuery(layerName) {
+    var query = '?k=' + hvQuery[layerName];
+    if (hvQuery.min_bp !== '') { query += '&min_bp=' + hvQuery.min_bp; }
+    if (hvQuery.max_bp !== '') { query += '&max_bp=' + hvQuery.max_bp; }
+    return query;
+}
+function hvMarkersUrl(layerName) { return 'api/' + layerName + '/clusters' + hvLayerQuery(layerName); }
+function hvClusterUrl(layerName, clusterId) { return 'api/' + layerName + '/clusters/' + clusterId + hvLayerQuery(layerName); }
+document.getElementById('hv-apply').addEventListener('click', function () {
+    hvQuery.Y = document.getElementById('hv-k-Y').value;
+    hvQuery.mt = document.getElementById('hv-k-mt').value;
+    hvQuery.min_bp = document.getElementById('hv-min-bp').value;
+    hvQuery.max_bp = document.getElementById('hv-max-bp').value;
+    $map_name.closePopup();
+    Object.keys(hvFeatureGroups).forEach(hvReloadMarkers);
+});
+</script>""")
+
+
+def server_page(cluster_Y, cluster_mt, bp_range_categories, tiles_url=None, assets_dir=None):
+    '''
+
+    Parameters
+    ----------
+    cluster_Y, cluster_mt : int
+        Initial cluster numbers.
+    bp_range_categories : list
+        BP range categories present in the data.
+    tiles_url : str
+        URL template of local map tiles, None for the Esri satellite tiles.
+    assets_dir : str
+        Directory of local copies of the map libraries, loaded from /assets/ instead of their network URL.
+
+    Returns
+    -------
+    html : str
+        Map page of the map server: markers and popups are fetched from its endpoints (see serve_map),
+        plotly.js is inlined.
+
+    '''
+
+    m, fg_Y, fg_mt = create_map(tiles_url)
+    add_client_markers(fg_Y, 'Y', 'server')
+    add_client_markers(fg_mt, 'mt', 'server')
+    add_page_popups(m, {}, 'server', offline=True)
+    m.get_root().html.add_child(page_element(SERVER_CONTROLS.substitute(map_name=m.get_name(), k_Y=cluster_Y, k_mt=cluster_mt)))
+    add_bp_range_filter(m, bp_range_categories)
+    html = m.get_root().render()
+
+    return localize_html(html, assets_dir, "/assets") if assets_dir else html
+
+
+def filter_mean_bp(annotations, min_bp=None, max_bp=None):
+    '''
+
+    Returns
+    -------
+    annotations : pandas dataframe
+        The samples with a mean BP between min_bp and max_bp (both included, no limit if None).
+
+    '''
+
+    if min_bp is not None:
+        annotations = annotations[annotations["Mean BP"] >= min_bp]
+    if max_bp is not None:
+        annotations = annotations[annotations["Mean BP"] <= max_bp]
+
+    return annotations
+
+
+def server_query(query, default_k):
+    '''
+
+    Parameters
+    ----------
+    query : dict
+        Parsed query string of a request (see urllib.parse.parse_qs).
+    default_k : int
+        Cluster number of the layer if the query has none.
+
+    Returns
+    -------
+    k, min_bp, max_bp : int, int or None, int or None
+        Cluster number and mean BP range of the request. Invalid values raise a ValueError.
+
+    '''
+
+    def query_int(name, default):
+        values = query.get(name, [""])
+        if values[-1] == "":
+            return default
+        try:
+            return int(values[-1])
+        except ValueError:
+            raise ValueError(f"{name} must be an integer") from None
+
+    k = query_int("k", default_k)
+    if not (5 <= k <= 500):
+        raise ValueError("k must be between 5 and 500")
+
+    return k, query_int("min_bp", None), query_int("max_bp", None)
+
+
+def serve_map(annotations, bp_range_categories, cluster_numbers, host, port, cluster_options=None, tiles_dir=None, assets_dir=None):
+    '''
+
+    Serves the map page and its JSON endpoints until interrupted (Ctrl+C):
+
+        GET /                                    map page
+        GET /api/<layer>/clusters                markers of the layer's clusters (location and BP range tags)
+        GET /api/<layer>/clusters/<cluster id>   legend data and haplogroup counts of a cluster
+        GET /tiles/<z>/<x>/<y>.<extension>       map tile from tiles_dir
+        GET /assets/<file name>                  map library from assets_dir
+
+    The endpoints take the query parameters k (cluster number, re-clusters the layer), min_bp and max_bp
+    (only samples with a mean BP in this range). Layers are 'Y' and 'mt'.
+
+    Parameters
+    ----------
+    annotations : dict
+        Cleaned samples by layer name ('Y', 'mt'), as returned by load_cleaned_tables.
+    bp_range_categories : list
+        BP range categories present in the data.
+    cluster_numbers : dict
+        Default cluster number by layer name.
+    host, port
+        Address of the server.
+    cluster_options : dict
+        Clustering engine, weighting, geometry and cache, see cluster_locations (clusterings of BP ranges are not
+        cached on disk, only the last SERVER_CACHE_SIZE in memory).
+    tiles_dir : str
+        Directory of local map tiles ({z}/{x}/{y}.<extension>), None for the Esri satellite tiles.
+    assets_dir : str
+        Directory of local copies of the map libraries (the others are loaded from the network).
+
+    '''
+
+    import functools
+    import http.server
+    import mimetypes
+    import urllib.parse
+
+    tiles_extension = tile_extension(tiles_dir) if tiles_dir else None
+    tiles_url = f"/tiles/{{z}}/{{x}}/{{y}}.{tiles_extension}" if tiles_extension else None
+    page = server_page(cluster_numbers['Y'], cluster_numbers['mt'], bp_range_categories, tiles_url, assets_dir)
+    network = ([] if tiles_url else ["Esri satellite tiles"]) + network_files(page)
+    page = page.encode("utf-8")
+
+    @functools.lru_cache(maxsize=SERVER_CACHE_SIZE)
+    def clustered_layer(layer, k, min_bp, max_bp):
+        # Cluster the samples in the BP range (at most one cluster per location), None if there are none
+        samples = filter_mean_bp(annotations[layer], min_bp, max_bp)
+        n_locations = len(samples[["Lat", "Long"]].drop_duplicates())
+        if n_locations == 0:
+            return None
+        # Only whole layers are cached on disk (one file per k); one-off BP range queries would fill the cache directory
+        options = dict(cluster_options or {})
+        if min_bp is not None or max_bp is not None:
+            options.pop('cache_dir', None)
+        return cluster_layer(samples, min(k, n_locations), **options)
+
+    class MapRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        def send_body(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data, status=200):
+            self.send_body(status, json.dumps(data, separators=(",", ":")).encode("utf-8"), "application/json")
+
+        def send_file(self, file_path):
+            if not os.path.isfile(file_path):
+                return self.send_json({'error': f"Unknown path {self.path}"}, 404)
+            with open(file_path, "rb") as file:
+                body = file.read()
+            self.send_body(200, body, mimetypes.guess_type(file_path)[0] or "application/octet-stream")
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            path = url.path.strip("/").split("/")
+            if url.path == "/":
+                return self.send_body(200, page, "text/html; charset=utf-8")
+            # Local tiles and map libraries (plain file names only, nothing outside their directory)
+            if tiles_extension and path[0] == "tiles" and TILE_PATTERN.fullmatch("/".join(path[1:])) and path[-1].endswith(f".{tiles_extension}"):
+                return self.send_file(os.path.join(tiles_dir, *path[1:]))
+            if assets_dir and len(path) == 2 and path[0] == "assets" and path[1] == os.path.basename(path[1]) and path[1] not in ("", ".", ".."):
+                return self.send_file(os.path.join(assets_dir, path[1]))
+            if len(path) not in (3, 4) or path[0] != "api" or path[1] not in annotations or path[2] != "clusters":
+                return self.send_json({'error': f"Unknown path {url.path}"}, 404)
+
+            # Clustering of the layer for the query (cached)
+            layer = path[1]
+            try:
+                k, min_bp, max_bp = server_query(urllib.parse.parse_qs(url.query), cluster_numbers[layer])
+            except ValueError as error:
+                return self.send_json({'error': str(error)}, 400)
+            clusters = clustered_layer(layer, k, min_bp, max_bp)
+            if clusters is None:
+                return self.send_json({})
+            metadata, counts, nodes = clusters
+
+            # Markers of all clusters, or the data of one cluster
+            if len(path) == 3:
+                return self.send_json({cluster_id: marker_record(cluster) for cluster_id, cluster in metadata.iterrows()})
+            if not path[3].isdigit() or int(path[3]) not in metadata.index:
+                return self.send_json({'error': f"Unknown cluster {path[3]}"}, 404)
+            cluster_id = int(path[3])
+            record = sidecar_cluster_record(metadata.loc[cluster_id], counts, nodes, cluster_id)
+            return self.send_json({key: value for key, value in record.items() if key not in ('location', 'tags')})
+
+    # Cluster the layers with the default cluster numbers before the first request
+    for layer, k in cluster_numbers.items():
+        clustered_layer(layer, k, None, None)
+
+    try:
+        server = http.server.HTTPServer((host, port), MapRequestHandler)
+    except OSError as error:
+        terminate(f"Cannot serve the map at {host}:{port} ({error.strerror}).", EXIT_USAGE)
+    print(f"Serving the map at http://{host}:{server.server_port}/ (press Ctrl+C to stop)")
+    if network:
+        print(f"The map page loads {len(network)} files from the network (see --tiles_dir and --assets_dir): " + ", ".join(network))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+
+###############################################################################
+
+# Functions for stage timings:
+
+# Stage timings of this run as (stage, seconds), shown with --timings
+stage_times = []
+
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    '''
+
+    Records the run time of the enclosed code as a stage (including the imports it triggers).
+
+    '''
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times.append((stage, time.perf_counter() - start))
+
+
+def report_timings():
+    '''
+
+    Prints the stage timings of this run.
+
+    '''
+
+    for stage, seconds in stage_times:
+        print(f"Timing: {stage:<32} {seconds:8.3f} s")
+    print(f"Timing: {'total':<32} {time.perf_counter() - START_TIME:8.3f} s")
+
+
+
+###############################################################################
+
+# Main program:
+
+def main(argv):
+    '''
+
+    Parameters
+    ----------
+    argv : list
+        Command-line arguments (without the program name).
+
+    '''
+
+    # Parse and check command-line arguments (no non-standard module is imported yet, so invalid calls fail immediately)
+    args = parse_arguments(argv)
+    stage_times.append(("startup and argument checks", time.perf_counter() - START_TIME))
+
+    # Load and preprocess annotation file data (cached cleaned tables if available)
+    with timed_stage("loading and preprocessing"):
+        try:
+            annotations_Y, annotations_mt, bp_range_categories = load_cleaned_tables(args.input_file, cache_dir=args.cache_dir, refresh=args.refresh_cache)
+        except ValueError as error:
+            terminate(f"{error}.", EXIT_INPUT_DATA)
+
+    # Clustering engine, weighting and geometry (see cluster_locations), clusterings cached in the cache directory
+    cluster_options = {'engine': args.cluster_engine, 'weighted': not args.unweighted, 'geometry': args.geometry,
+                       'cache_dir': args.cache_dir, 'refresh': args.refresh_cache}
+
+    # Grid binning instead of clusters (map only)
+    if getattr(args, 'binning', None):
+        cluster_options.update(binning=args.binning, cell_size=args.cell_size)
+
+    # Automatic cluster numbers (elbow of the inertia curve within the time budget, not needed with a binning)
+    if 'auto' in (args.cluster_Y, args.cluster_mt) and args.command != 'sweep' and 'binning' not in cluster_options:
+        with timed_stage("automatic cluster numbers"):
+            try:
+                if args.cluster_Y == 'auto':
+                    args.cluster_Y = auto_cluster_number(annotations_Y, args.auto_budget, cluster_options, 'Y')
+                if args.cluster_mt == 'auto':
+                    args.cluster_mt = auto_cluster_number(annotations_mt, args.auto_budget, cluster_options, 'mt')
+            except ValueError as error:
+                terminate(f"{error}.", EXIT_CLUSTER_RANGE)
+
+    # Map server (clusters on request)
+    if args.command == 'serve':
+        if args.cache_report:
+            report_cache()
+        if args.timings:
+            report_timings()
+        serve_map({'Y': annotations_Y, 'mt': annotations_mt}, bp_range_categories,
+                  {'Y': args.cluster_Y, 'mt': args.cluster_mt}, args.host, args.port, cluster_options, args.tiles_dir, args.assets_dir)
+        return
+
+    # Cluster number sweep (the maps reuse the cached clusterings of the sweep)
+    if args.command == 'sweep':
+        with timed_stage("sweep"):
+            sweep_cluster_numbers({'Y': annotations_Y, 'mt': annotations_mt}, args.k_values, args.jobs, cluster_options)
+        if args.maps:
+            with timed_stage("sweep maps"):
+                for k in args.k_values:
+                    sweep_map(f"{args.maps}_k{k}.html", {'Y': cluster_layer(annotations_Y, k, **cluster_options),
+                                                          'mt': cluster_layer(annotations_mt, k, **cluster_options)}, bp_range_categories)
+        if args.cache_report:
+            report_cache()
+        if args.timings:
+            report_timings()
+        return
+
+    # K means clustering, cluster metadata tables and haplogroup counts per cluster, and the sunburst popups
+    # ('iframe' and 'shared' popup mode), for Y and mt concurrently if there are several CPUs
+    popup_mode = args.popup_mode if args.command == 'map' else None
+    stage = "clustering and popup rendering" if popup_mode in ('iframe', 'shared') else "clustering"
+    with timed_stage(stage):
+        layers = run_layer_pipelines({'Y': (annotations_Y, args.cluster_Y), 'mt': (annotations_mt, args.cluster_mt)},
+                                     concurrent=not args.sequential_layers and (os.cpu_count() or 1) > 1,
+                                     popup_mode=popup_mode, renderer=getattr(args, 'renderer', 'go'), jobs=getattr(args, 'jobs', 1),
+                                     cluster_options=cluster_options)
+        metadata_Y, counts_Y, nodes_Y, rendered_Y = layers['Y']
+        metadata_mt, counts_mt, nodes_mt, rendered_mt = layers['mt']
+    if args.cache_report:
+        report_cache()
+
+    # Clustering engine and renderer benchmarks instead of a map
+    if args.command == 'benchmark':
+        benchmark_engines({'Y': (annotations_Y, args.cluster_Y), 'mt': (annotations_mt, args.cluster_mt)}, not args.unweighted, args.geometry)
+        benchmark_renderers({'Y': (metadata_Y, counts_Y, nodes_Y), 'mt': (metadata_mt, counts_mt, nodes_mt)})
+        if args.timings:
+            report_timings()
+        return
+
+    if args.cluster_table:
+        export_cluster_table(metadata_Y, f"{args.cluster_table}_Y.csv")
+        export_cluster_table(metadata_mt, f"{args.cluster_table}_mt.csv")
+        export_haplogroup_counts(counts_Y, nodes_Y, f"{args.cluster_table}_Y_haplogroups.csv")
+        export_haplogroup_counts(counts_mt, nodes_mt, f"{args.cluster_table}_mt_haplogroups.csv")
+
+    # Initialize map with Y and mt layers
+    with timed_stage("map setup"):
+        m, fg_Y, fg_mt = create_map(args.tiles_url)
+
+    # Coarser cluster levels for zoomed-out views
+    levels_Y = levels_mt = None
+    if args.zoom_levels:
+        with timed_stage("zoom levels"):
+            levels_Y = cluster_hierarchy(metadata_Y, counts_Y, args.geometry)
+            levels_mt = cluster_hierarchy(metadata_mt, counts_mt, args.geometry)
+
+    # Add markers with popups to map (and the popup data to the map page in 'shared' and 'lazy' popup mode)
+    with timed_stage("markers and popups"):
+        popup_data = {
+            'Y': add_cluster_markers(fg_Y, metadata_Y, counts_Y, nodes_Y, args.renderer, args.popup_mode, 'Y', args.jobs, rendered_Y, levels_Y),
+            'mt': add_cluster_markers(fg_mt, metadata_mt, counts_mt, nodes_mt, args.renderer, args.popup_mode, 'mt', args.jobs, rendered_mt, levels_mt)
+            }
+        if args.popup_mode == 'sidecar':
+            write_sidecar_files(sidecar_dir(args.output), popup_data)
+        if args.popup_mode != 'iframe':
+            add_page_popups(m, popup_data, args.popup_mode, args.offline, sidecar_dir(args.output))
+
+    # BP range filter and save map (offline maps only if every library has a local copy)
+    with timed_stage("saving map"):
+        add_bp_range_filter(m, bp_range_categories)
+        if args.offline:
+            # Libraries beyond MAP_LIBRARY_URLS (other folium versions)
+            missing = missing_assets(m.get_root().render(), args.assets_dir)
+            if missing:
+                terminate(f"Offline maps need local copies of the map libraries; place these {len(missing)} files in the --assets_dir directory: "
+                          + ", ".join(missing), EXIT_INPUT_MISSING)
+        m.save(args.output)
+        if args.assets_dir:
+            localize_assets(args.output, args.assets_dir)
+    if args.offline:
+        report_bundle_size(args.output)
+    if args.timings:
+        report_timings()
+
+    # Open map (browsers do not fetch the sidecar files for a page opened from disk, so it has to be served)
+    if args.popup_mode == 'sidecar':
+        import urllib.parse
+        print(f'Serve the map directory to open the map, e.g. python -m http.server --directory "{os.path.dirname(os.path.abspath(args.output))}" '
+              f'and open http://localhost:8000/{urllib.parse.quote(os.path.basename(args.output))}')
+    else:
+        os.system(f'"{args.output}"')
+
 
+if __name__ == "__main__":
+    main(sys.argv[1:])